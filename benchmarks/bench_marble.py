@@ -0,0 +1,156 @@
+"""
+Benchmarks for reality marble operations on synthetic marbles and host trees.
+
+Everything is built under a temporary directory, joint paths included, so no
+privilege is needed. Results are written as JSON to be compared between releases:
+
+    $ python benchmarks/bench_marble.py --sizes 10,100,1000,10000 -o bench.json
+"""
+import json
+import math
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import click
+
+from realitymarble import RealityMarble
+from realitymarble import primitives
+
+
+PHANTASM_TYPES = ['realitymarble.Phantasm', 'realitymarble.NoHiddenPhantasm', 'realitymarble.ScriptsPhantasm']
+
+
+def relpaths(count, layout, phantasm_type):
+    """synthetic relative paths of external files under a joint path"""
+    for i in range(count):
+        if layout == 'flat':
+            parts = ['file{}'.format(i)]
+        else:
+            # eight levels deep, ten entries per directory
+            parts = ['d{}'.format((i // 10 ** level) % 10) for level in range(7, 0, -1)] + ['file{}'.format(i)]
+        if phantasm_type == 'realitymarble.NoHiddenPhantasm':
+            parts[0] = '.' + parts[0]
+        yield os.path.join(*parts)
+
+
+def build(root, count, layout, phantasms):
+    """build a marble with its config, and host files spread over the given number of phantasms,
+    returns marble path and list of external paths"""
+    marble_path = os.path.join(root, 'marble')
+    host = os.path.join(root, 'host')
+    os.makedirs(marble_path)
+    config = {'phantasms': []}
+    externals = []
+    for n in range(phantasms):
+        phantasm_type = PHANTASM_TYPES[n % len(PHANTASM_TYPES)]
+        joint_path = os.path.join(host, 'joint{}'.format(n))
+        config['phantasms'].append({
+            'name': 'phantasm{}'.format(n),
+            'type': phantasm_type,
+            'joint_path': joint_path,
+        })
+        share = count // phantasms + (1 if n < count % phantasms else 0)
+        for relpath in relpaths(share, layout, phantasm_type):
+            external = os.path.join(joint_path, relpath)
+            os.makedirs(os.path.dirname(external), exist_ok=True)
+            with open(external, 'w') as f:
+                f.write('setting = {}\n'.format(relpath) * 16)
+            externals.append(external)
+    with open(os.path.join(marble_path, '.realitymarble'), 'w') as fconfig:
+        json.dump(config, fconfig)
+    return (marble_path, externals)
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run_case(count, layout, phantasms, jobs):
+    root = tempfile.mkdtemp(prefix='realitymarble-bench-')
+    try:
+        (marble_path, externals) = build(root, count, layout, phantasms)
+        timings = {}
+        marble = None
+
+        def load():
+            nonlocal marble
+            marble = RealityMarble(marble_path)
+        timings['load_config'] = timed(load)
+        timings['match_phantasms'] = timed(lambda: [marble._match_phantasms(path) for path in externals])
+        timings['collect'] = timed(lambda: list(marble.iter_results('collect', externals, jobs=jobs)))
+
+        for path in externals:
+            os.unlink(path)
+        timings['project'] = timed(lambda: list(marble.iter_results('project', externals, jobs=jobs)))
+        timings['status'] = timed(lambda: list(marble.status(jobs=jobs)))
+        timings['materialize'] = timed(lambda: list(marble.iter_results('materialize', externals, jobs=jobs)))
+
+        pairs = [(path, marble._match_phantasms(path)[1].internal_path) for path in externals]
+        timings['maybe_merge'] = timed(lambda: [primitives.maybe_merge(*pair) for pair in pairs])
+        timings['apply'] = timed(lambda: marble.apply())
+        return timings
+    finally:
+        shutil.rmtree(root)
+
+
+def scaling(results):
+    """log-log slope of time against file count between consecutive sizes, 1.0 means linear"""
+    exponents = {}
+    for (case, by_size) in results.items():
+        sizes = sorted(by_size, key=int)
+        exponents[case] = {}
+        for (small, large) in zip(sizes, sizes[1:]):
+            for (operation, seconds) in by_size[large].items():
+                base = by_size[small][operation]
+                if base > 0 and seconds > 0:
+                    slope = math.log(seconds / base) / math.log(int(large) / int(small))
+                    exponents[case].setdefault(operation, {})['{}-{}'.format(small, large)] = round(slope, 3)
+    return exponents
+
+
+@click.command()
+@click.option('--sizes', default='10,100,1000', show_default=True,
+              help='Comma separated file counts')
+@click.option('--layouts', default='flat,deep', show_default=True,
+              help='Comma separated directory layouts')
+@click.option('--phantasms', default=3, show_default=True,
+              help='Number of phantasms in the synthetic marble')
+@click.option('--jobs', '-j', default=8, show_default=True,
+              help='Number of files processed concurrently')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default=None,
+              help='Write results as JSON to this file')
+def main(sizes, layouts, phantasms, jobs, output):
+    """
+    Time reality marble operations against growing synthetic marbles.
+    """
+    results = {}
+    for layout in layouts.split(','):
+        case = '{}-{}phantasms'.format(layout, phantasms)
+        results[case] = {}
+        for count in [int(size) for size in sizes.split(',')]:
+            timings = run_case(count, layout, phantasms, jobs)
+            results[case][str(count)] = timings
+            click.echo('{:24} {:>7} files  '.format(case, count) +
+                       '  '.join('{} {:.3f}s'.format(op, seconds) for (op, seconds) in timings.items()))
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'jobs': jobs,
+        'results': results,
+        'scaling': scaling(results),
+    }
+    if output:
+        with open(output, 'w') as fout:
+            json.dump(report, fout, indent=2)
+    else:
+        click.echo(json.dumps(report['scaling'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
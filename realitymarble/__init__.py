@@ -1,12 +1,26 @@
 from __future__ import print_function
 
+import collections
+import contextlib
+import functools
 import os
-import json
+import stat
 import sys
 import logging
+import threading
+import time
 
+from realitymarble import config
+from realitymarble import plan as planner
 from realitymarble import primitives
 from realitymarble import utils
+from realitymarble.backup import BackupStore
+from realitymarble.index import StateIndex
+from realitymarble.instrument import stats
+from realitymarble.journal import Journal
+from realitymarble.objects import BASES_NAME, OBJECTS_NAME, ObjectStore
+from realitymarble.utils import sudolib
+from realitymarble.utils.pathtrie import PathTrie
 
 
 logger = logging.getLogger(__name__)
@@ -37,10 +51,35 @@ DEFAULT_CONFIG = """
 
 class Phantasm(object):
     """A Phantasm is where your config files live"""
+    # where the system the joint path belongs to is mounted
+    root = os.sep
+    # base paths of this phantasm in every layer, if the reality marble has layers
+    managed_paths = None
 
-    def __init__(self, base_path, joint_path):
+    def __init__(self, base_path, joint_path, include=None, exclude=None):
         self.base_path = utils.canonical_path(base_path)
         self.joint_path = utils.canonical_path(joint_path)
+        self.set_filters(include, exclude)
+
+    @classmethod
+    def from_config(cls, base_path, joint_path, include=None, exclude=None, root=os.sep):
+        """create a phantasm from paths already resolved when the config was compiled, maybe inside
+        another root, so they are taken as they are. Subclasses with their own constructor may
+        only take the two paths, they get called with them and everything else is set afterwards."""
+        if cls.__init__ is Phantasm.__init__:
+            phantasm = cls.__new__(cls)
+        else:
+            phantasm = cls(base_path, joint_path)
+        phantasm.base_path = base_path
+        phantasm.joint_path = joint_path
+        phantasm.set_filters(include, exclude)
+        phantasm.root = root
+        return phantasm
+
+    def set_filters(self, include=None, exclude=None):
+        """only entries matching glob patterns in include and none in exclude are discoverable"""
+        self._include = utils.compile_globs(include)
+        self._exclude = utils.compile_globs(exclude)
 
     def match(self, external_path):
         """Attempt to match against external_path, if succeed,
@@ -60,8 +99,35 @@ class Phantasm(object):
         """Adjust target before returns it"""
         return internal_path
 
+    def _unadjust(self, internal_path):
+        """Reverse of _adjust"""
+        return internal_path
+
+    def iter_operations(self, known=None):
+        """Yield an operation object for every file inside this phantasm.
+        known maps internal paths to external paths they were recorded with,
+        those are used instead of reversing _adjust"""
+        for internal_path in utils.walk_files(self.base_path):
+            yield self._create_operation(internal_path, self._external_path(internal_path, known))
+
+    def _external_path(self, internal_path, known=None):
+        """where internal_path is projected to outside"""
+        external_path = known.get(internal_path) if known else None
+        if external_path is not None and utils.is_sub(self.joint_path, external_path):
+            return external_path
+        relpath = os.path.relpath(self._unadjust(internal_path), self.base_path)
+        return os.path.join(self.joint_path, relpath)
+
     def _create_operation(self, internal_path, external_path):
-        return primitives.operations(self.base_path, internal_path, external_path)
+        return primitives.operations(self.base_path, internal_path, external_path, root=self.root,
+                                     managed_paths=self.managed_paths)
+
+    def discoverable(self, relpath, is_dir):
+        """if the entry at relpath inside joint_path may be collected into this phantasm,
+        directories that are not discoverable are skipped as a whole"""
+        if self._exclude is not None and self._exclude.match(relpath):
+            return False
+        return is_dir or self._include is None or self._include.match(relpath) is not None
 
 
 class NoHiddenPhantasm(Phantasm):
@@ -73,95 +139,370 @@ class NoHiddenPhantasm(Phantasm):
             relpath = relpath[1:]
         return os.path.join(self.base_path, relpath)
 
+    def _unadjust(self, internal_path):
+        # without a record of where it came from, a file is assumed to be hidden outside,
+        # as non hidden ones are indistinguishable
+        relpath = os.path.relpath(internal_path, self.base_path)
+        return os.path.join(self.base_path, '.' + relpath)
+
+    def discoverable(self, relpath, is_dir):
+        # only hidden entries come back to the same place when projected
+        if os.sep not in relpath and not relpath.startswith('.'):
+            return False
+        return super(NoHiddenPhantasm, self).discoverable(relpath, is_dir)
+
 
 class ScriptsPhantasm(Phantasm):
     """A specilized Phantasm that focused on handling executable scripts"""
     pass
 
 
+class DirectoryPhantasm(Phantasm):
+    """A specilized Phantasm that projects a whole directory as a single symlink,
+    as long as nothing else lives in the directory outside. Only where the external
+    directory already exists, files inside it are linked one by one."""
+
+    def iter_operations(self, known=None):
+        stack = [self.base_path] if os.path.isdir(self.base_path) else []
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    external_path = self._external_path(entry.path, known)
+                    if entry.is_dir(follow_symlinks=False) and \
+                            os.path.isdir(external_path) and not os.path.islink(external_path):
+                        # there may be unmanaged siblings outside, go file by file
+                        stack.append(entry.path)
+                        continue
+                    yield self._create_operation(entry.path, external_path)
+
+
+class OperationError(Exception):
+    """An operation on a path could not be carried out, the message tells why"""
+    pass
+
+
+# outcomes of a single operation in a result record
+OK = 'ok'
+FAILED = 'failed'
+
+Result = collections.namedtuple('Result', ['path', 'action', 'outcome', 'reason', 'elapsed'])
+
+
+ApplyResult = collections.namedtuple('ApplyResult', ['root', 'projected', 'skipped', 'failed', 'elapsed'])
+
+
+def _batched(method):
+    """run the method inside a batch of its own, unless there is already one"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.batch(), stats.timer(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class RealityMarble(object):
     """docstring for RealityMarble"""
-    phantasms = []
 
-    def __init__(self, path):
+    def __init__(self, path, root=os.sep):
         super(RealityMarble, self).__init__()
         self.path = utils.canonical_path(path)
+        self.root = utils.canonical_path(root)
+        if self.root != os.sep and not utils.is_sub(self.root, self.path):
+            logger.warning('Reality marble is outside of root %s, projected links only resolve outside of it',
+                           self.root)
+        self.phantasms = []
+        self._phantasm_index = PathTrie()
+        self._batch_depth = 0
+        self._batch_lock = threading.Lock()
+        self._bases = None
+        self._layered = {}
+        self._view = None
+        self._view_lock = threading.Lock()
+        self.stats = stats
         # load config file
         self.setup()
+        self.index = StateIndex(self.path)
+        self.journal = Journal(self.path)
+        self._recover()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group operations together, state is written back once when the outermost batch ends"""
+        with self._batch_lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._batch_lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    with stats.timer('commit'):
+                        self.index.save()
+                        self.journal.commit(self.index.path)
+
+    def _recover(self):
+        """finish or undo operations interrupted by a crash, as recorded in the journal"""
+        if not self.journal.try_lock():
+            # records are still being written by a live process
+            logger.debug('Reality marble is busy, not recovering')
+            return
+        pending = self.journal.pending()
+        if not pending:
+            self.journal.unlock()
+            return
+        logger.warning('Recovering %d interrupted operations', len(pending))
+        with self.batch():
+            for record in pending:
+                oper = primitives.operations(record['base_path'], record['internal_path'],
+                                             record['external_path'], root=record.get('root', os.sep),
+                                             managed_paths=record.get('managed_paths'))
+                jid = self.journal.begin(record['action'], oper)
+                try:
+                    self._recover_operation(record['action'], oper)
+                except Exception:
+                    logger.error('Failed to recover %s of %s', record['action'], oper.external_path,
+                                 exc_info=True)
+                self.journal.done(jid)
+
+    def _recover_operation(self, action, oper):
+        internal_exists = primitives.exists(oper.internal_path)
+        external_state = oper.status() if internal_exists else None
+        if action == 'drop':
+            if internal_exists and external_state == primitives.REPLACED:
+                # already materialized, roll forward
+                primitives.remove(oper.internal_path)
+            if not primitives.exists(oper.internal_path):
+                self.index.remove(oper.internal_path)
+            return
+        if action == 'materialize':
+            # the copy replaces the link atomically, whichever is there is consistent
+            return
+
+        if not internal_exists:
+            # nothing made it into the reality marble, already rolled back
+            return
+        if external_state in (primitives.MISSING, primitives.REPLACED):
+            # content is safe in the reality marble, roll forward
+            logger.info('roll forward %s of %s', action, oper.external_path)
+            oper.project_unchecked()
+            self._record(oper)
+        elif external_state == primitives.PROJECTED:
+            self._record(oper)
+        elif action == 'collect':
+            # the external file was changed after copying, keep it instead
+            logger.info('roll back collect of %s', oper.external_path)
+            primitives.unlink(oper.internal_path)
+            utils.rmdir(os.path.dirname(oper.internal_path),
+                        stop_at=self.path, ignore_fail_on_non_empty=True)
 
+    @stats.timed('setup')
     def setup(self):
         # read config file inside it
-        config_path = utils.canonical_path(self.path, '.realitymarble')
+        config_path = os.path.join(self.path, config.CONFIG_NAME)
         if not os.path.exists(config_path):
             logger.warning(
-                'Writing default configuration file: {}'.format(config_path))
+                'Writing default configuration file: %s', config_path)
             with open(config_path, "w") as fconfig:
                 print(DEFAULT_CONFIG, file=fconfig)
-        with open(config_path) as fconfig:
-            config = json.load(fconfig)
-            self._create_phantasms(config)
-
-    def _create_phantasms(self, config):
-        for ph in config['phantasms']:
+        table = config.load(self.path, self.root)
+        self.layers = table['layers']
+        self._create_phantasms(table)
+        self._create_object_store(table)
+        self._create_backup_store(table)
+
+    def _create_phantasms(self, table):
+        for ph in table['phantasms']:
             clz = utils.import_by_name(ph['type'])
-            joint_path = utils.canonical_path(ph['joint_path'])
-            base_path = utils.canonical_path(self.path, ph['name'])
-            self.phantasms.append(clz(base_path, joint_path))
+            phantasm = clz.from_config(ph['base_path'], ph['joint_path'], ph['include'], ph['exclude'], self.root)
+            self.phantasms.append(phantasm)
+            self._phantasm_index.insert(phantasm.joint_path, phantasm)
+            if not ph['layer_paths']:
+                continue
+            # the same phantasm in every layer, lowest first
+            stack = [phantasm] + [clz.from_config(layer_path, ph['joint_path'], ph['include'], ph['exclude'], self.root)
+                                  for layer_path in ph['layer_paths']]
+            for layer in stack:
+                layer.managed_paths = [ph['base_path']] + ph['layer_paths']
+            self._layered[phantasm] = stack
+
+    def _merged_view(self):
+        """Operation objects of every file in layered phantasms, each from the highest layer providing it,
+        keyed by phantasm and external path. Computed once, then kept up to date by _invalidate."""
+        with self._view_lock:
+            if self._view is None:
+                view = {}
+                known = self._known_external_paths()
+                for (phantasm, stack) in self._layered.items():
+                    view[phantasm] = files = {}
+                    for layer in stack:
+                        for oper in layer.iter_operations(known):
+                            files[oper.external_path] = oper
+                logger.debug('merged %d layers', len(self.layers) + 1)
+                self._view = view
+            return self._view
+
+    def _forget_view(self):
+        """compute the merged view again when it's needed next, after layers changed behind our back"""
+        with self._view_lock:
+            self._view = None
+
+    def _refresh_view(self, oper):
+        """resolve the external path of oper from the layers again, after files in them changed"""
+        with self._view_lock:
+            phantasm = next(self._phantasm_index.matches(oper.external_path), None)
+            if self._view is None or phantasm not in self._layered:
+                return
+            files = self._view[phantasm]
+            files.pop(oper.external_path, None)
+            for layer in reversed(self._layered[phantasm]):
+                (score, layer_oper) = layer.match(oper.external_path)
+                if score != 0 and primitives.exists(layer_oper.internal_path):
+                    files[oper.external_path] = layer_oper
+                    break
+
+    def _create_object_store(self, table):
+        self.objects = None
+        options = table['object_store']
+        if not options:
+            return
+        if options is True:
+            options = {}
+        self.objects = ObjectStore(self.path, **options)
+
+    def _create_backup_store(self, table):
+        self.backups = None
+        options = table['backup']
+        if not options:
+            return
+        if options is True:
+            options = {}
+        self.backups = BackupStore(self.path, **options)
+
+    @property
+    def bases(self):
+        """Where base versions for merging are kept, objects are stored there anyway if enabled.
+        Hardlinked objects change whenever their files are edited in place, so then bases are
+        kept in a store of their own."""
+        if self.objects is not None and self.objects.link_mode != 'hardlink':
+            return self.objects
+        if self._bases is None:
+            name = OBJECTS_NAME if self.objects is None else BASES_NAME
+            self._bases = ObjectStore(self.path, name=name)
+        return self._bases
+
+    def _store(self, src, dest):
+        """put a copy of src at dest inside the reality marble"""
+        if self.objects is None:
+            return primitives.copy(src, dest)
+        digest = self.objects.add(src)
+        self.objects.link(digest, dest)
 
     def _match_phantasms(self, path):
+        """find the phantasm with the longest joint_path containing path,
+        only the winner is asked to match and build its operation object"""
         logger.debug('matching %s', path)
-        matchlist = sorted([ph.match(path)
-                            for ph in self.phantasms], reverse=True)
-        logger.debug('matchlist is {}'.format(matchlist))
-        return matchlist[0]
+        for ph in self._phantasm_index.matches(path):
+            (score, oper) = ph.match(path)
+            if score != 0:
+                logger.debug('matched %s with score %d', ph.base_path, score)
+                if ph in self._layered:
+                    oper = self._merged_view()[ph].get(oper.external_path, oper)
+                return (score, oper)
+        return (0, None)
 
     def dump_config(self):
         logger.info('Reality Marble at %s', self.path)
+        for layer in self.layers:
+            logger.info('    overlaid by %s', layer)
         for ph in self.phantasms:
             logger.info('    %s (%s), type: %s', ph.base_path,
                         ph.joint_path, ph.__class__.__name__)
 
+    def _record(self, oper):
+        """record the operation in the index, the index only tracks the system at our own root.
+        The recorded content is kept as the base version for merging later changes."""
+        if oper.root != self.root:
+            return
+        entry = self.index.record(oper)
+        if entry.hash is not None and entry.hash not in self.bases:
+            self.bases.add(oper.internal_path)
+
+    def _base_version(self, oper):
+        """path to the content of the internal file as of the last collect or project, if it is known"""
+        entry = self.index.get(oper.internal_path)
+        if entry is None or entry.hash is None or entry.hash not in self.bases:
+            return None
+        return self.bases.object_path(entry.hash)
+
+    def _invalidate(self, oper):
+        """bring the merged view up to date after the operation changed files"""
+        if self._layered:
+            self._refresh_view(oper)
+
     def resolve_external_path(self, path):
         path = utils.canonical_path(path, resolve_link=False)
+        if not utils.is_sub(self.root, path):
+            path = utils.canonical_path(utils.rebase(path, self.root), resolve_link=False)
+        # a symlink to a directory is managed as the link itself, not what it points to
+        path = path.rstrip(os.sep) or os.sep
+        (parent, name) = os.path.split(path)
+        if self.root != os.sep and utils.is_sub(self.root, parent):
+            path = os.path.join(utils.resolve_in_root(parent, self.root), name)
         if utils.is_sub(self.path, path):
             logger.error('Skip files inside our base')
             return None
         return path
 
-    def collect(self, path):
-        finished = False
+    def _resolve(self, path, unmatched):
+        """the operation object for path, raises OperationError with unmatched as the reason
+        if no phantasm matches it"""
         if len(self.phantasms) == 0:
-            logger.error('No configured phantasm found.')
-            return finished
-
-        path = self.resolve_external_path(path)
-        if not path:
-            return finished
+            raise OperationError('No configured phantasm found.')
 
-        if os.path.islink(path):
-            logger.error('Cannot collect a symlink.')
-            return finished
+        resolved = self.resolve_external_path(path)
+        if not resolved:
+            raise OperationError('Inside the reality marble: {}'.format(path))
 
-        (score, oper) = self._match_phantasms(path)
+        (score, oper) = self._match_phantasms(resolved)
         if score == 0:
-            logger.error('No matching phantasm found')
-            return finished
+            raise OperationError(unmatched.format(resolved))
+        return oper
+
+    def _guarded(self, method, path):
+        """run method on path, failures are logged and reported as False like they always were"""
+        try:
+            return method(path)
+        except OperationError as err:
+            logger.error('%s', err)
+            return False
+
+    @_batched
+    def collect(self, path):
+        return self._guarded(self._collect_path, path)
+
+    def _collect_path(self, path):
+        oper = self._resolve(path, 'No matching phantasm found: {}')
+        item = planner.plan_collect(oper)
+        if item.conflict:
+            raise OperationError(item.conflict)
 
-        if primitives.exists(oper.internal_path):
-            logger.error('Existing files found in the reality marble, try project instead: {}'.format(
-                oper.internal_path))
-            return finished
+        return self._collect(oper)
 
-        logger.debug('collecting {} to {}'.format(
-            oper.external_path, oper.internal_path))
+    def _collect(self, oper):
+        finished = False
+        logger.debug('collecting %s to %s', oper.external_path, oper.internal_path)
+        jid = self.journal.begin('collect', oper)
         try:
-            primitives.copy(oper.external_path, oper.internal_path)
+            self._store(oper.external_path, oper.internal_path)
             oper.project_unchecked()
             finished = True
+            self._record(oper)
         except Exception as err:
-            logger.debug('Error while collect file: {}'.format(
-                oper.external_path), exc_info=True)
+            logger.debug('Error while collect file: %s', oper.external_path, exc_info=True)
+            if not finished:
+                raise OperationError('Error while collecting {}: {}'.format(oper.external_path, err)) from err
         finally:
+            self._invalidate(oper)
             if not finished:
                 # clean up
                 logger.info('roll back partially done operation for collect')
@@ -169,151 +510,436 @@ class RealityMarble(object):
                 utils.rmdir(os.path.dirname(oper.internal_path),
                             stop_at=self.path,
                             ignore_fail_on_non_empty=True)
+            self.journal.done(jid)
         return finished
 
+    @_batched
     def drop(self, path):
-        finished = False
-        if len(self.phantasms) == 0:
-            logger.error('No configured phantasm found.')
-            return finished
-
-        path = self.resolve_external_path(path)
-        if not path:
-            return finished
-
-        (score, oper) = self._match_phantasms(path)
-        if score == 0:
-            logger.error(
-                'No matches found, this symlink is not managed by the reality marble.')
-            return finished
+        return self._guarded(self._drop_path, path)
 
+    def _drop_path(self, path):
+        finished = False
+        oper = self._resolve(path, 'No matches found, this symlink is not managed by the reality marble: {}')
         if not oper.managed():
-            logger.error('Not a managed symlink in the reality marble: {}'.format(
-                oper.external_path))
-            return finished
+            raise OperationError('Not a managed symlink in the reality marble: {}'.format(oper.external_path))
 
-        logger.debug('drop {} => {}'.format(
-            oper.external_path, oper.internal_path))
+        logger.debug('drop %s => %s', oper.external_path, oper.internal_path)
+        jid = self.journal.begin('drop', oper)
         try:
             oper.materialize_unchecked()
-            primitives.unlink(oper.internal_path)
+            primitives.remove(oper.internal_path)
             finished = True
+            self.index.remove(oper.internal_path)
         except Exception as err:
-            logger.debug('Error while collect file: {}'.format(
-                oper.external_path), exc_info=True)
+            logger.debug('Error while collect file: %s', oper.external_path, exc_info=True)
+            if not finished:
+                raise OperationError('Error while dropping {}: {}'.format(oper.external_path, err)) from err
         finally:
+            self._invalidate(oper)
             if not finished:
                 # clean up
                 logger.info('roll back partially done operation for collect')
+            self.journal.done(jid)
         return finished
 
+    @_batched
     def project(self, path):
-        finished = False
-        if len(self.phantasms) == 0:
-            logger.error('No configured phantasm found.')
-            return finished
+        return self._guarded(self._project_path, path)
 
-        path = self.resolve_external_path(path)
-        if not path:
-            return finished
+    def _project_path(self, path):
+        oper = self._resolve(
+            path, 'No matches found, the path trying to project to is not managed by the reality marble: {}')
+        item = planner.plan_project(oper)
+        if item.conflict:
+            raise OperationError(item.conflict)
+        if not item.steps:
+            logger.info('Already projected: %s', oper.external_path)
+            return True
 
-        (score, oper) = self._match_phantasms(path)
-        if score == 0:
-            logger.error(
-                'No matches found, the path trying to project to is not managed by the reality marble: {}'.format(path))
-            return finished
-
-        if not primitives.maybe_merge(oper.external_path, oper.internal_path):
-            logger.error('External file exists and merge failed: {}'.format(
-                oper.external_path))
-            return finished
+        return self._project(oper)
 
-        logger.debug('project {} => {}'.format(
-            oper.external_path, oper.internal_path))
+    def _project(self, oper):
+        finished = False
+        # a managed symlink from another layer has nothing to merge
+        stats.count('lstat')
+        if not os.path.islink(oper.external_path) and \
+                not primitives.maybe_merge(oper.external_path, oper.internal_path, self._base_version(oper)):
+            raise OperationError('External file exists and merge failed: {}'.format(oper.external_path))
+
+        self._backup(oper)
+        logger.debug('project %s => %s', oper.external_path, oper.internal_path)
+        jid = self.journal.begin('project', oper)
         try:
             oper.project_unchecked()
             finished = True
+            self._record(oper)
         except Exception as err:
-            logger.debug('Error while projecting file: {} => {}'.format(
-                oper.external_path, oper.internal_path), exc_info=True)
+            logger.debug('Error while projecting file: %s => %s', oper.external_path, oper.internal_path, exc_info=True)
+            if not finished:
+                raise OperationError('Error while projecting {}: {}'.format(oper.external_path, err)) from err
         finally:
+            self._invalidate(oper)
             if not finished:
                 # clean up
                 logger.info('roll back partially done operation for project')
+            self.journal.done(jid)
         return finished
 
-    def materialize(self, path):
-        finished = False
-        if len(self.phantasms) == 0:
-            logger.error('No configured phantasm found.')
-            return finished
+    def _logical_path(self, external_path, root):
+        """where external_path is as seen from inside root"""
+        return os.path.join(os.sep, os.path.relpath(external_path, root))
 
-        path = self.resolve_external_path(path)
-        if not path:
-            return finished
+    def _backup(self, oper):
+        """save the external file about to be replaced, if there is one"""
+        if self.backups is None:
+            return
+        stats.count('lstat')
+        try:
+            if not stat.S_ISREG(os.lstat(oper.external_path).st_mode):
+                return
+        except FileNotFoundError:
+            return
+        try:
+            self.backups.add(oper.external_path, self._logical_path(oper.external_path, oper.root))
+        except OSError as err:
+            # never replace what can't be brought back
+            raise OperationError('Cannot back up {}: {}'.format(oper.external_path, err)) from err
+
+    def list_backups(self, path):
+        """backups of path taken on any host, oldest first"""
+        if self.backups is None:
+            return []
+        external_path = utils.canonical_path(path, resolve_link=False)
+        if not utils.is_sub(self.root, external_path):
+            external_path = utils.rebase(external_path, self.root)
+        return list(self.backups.entries(self._logical_path(external_path, self.root)))
+
+    def restore(self, path):
+        return self._guarded(self._restore_path, path)
+
+    def _restore_path(self, path):
+        if self.backups is None:
+            raise OperationError('Backups are not enabled for this reality marble.')
+        external_path = self.resolve_external_path(path)
+        if not external_path:
+            raise OperationError('Inside the reality marble: {}'.format(path))
+        entry = self.backups.latest(self._logical_path(external_path, self.root))
+        if entry is None:
+            raise OperationError('No backup of {} taken on this host'.format(external_path))
+        logger.debug('restore %s from backup %s', external_path, entry.hash)
+        try:
+            self.backups.restore(entry, external_path)
+        except OSError as err:
+            raise OperationError('Cannot restore {}: {}'.format(external_path, err)) from err
+        return True
 
-        (score, oper) = self._match_phantasms(path)
-        if score == 0:
-            logger.error(
-                'No matches found, this symlink is not managed by the reality marble.')
-            return finished
+    ACTIONS = ('collect', 'drop', 'project', 'materialize', 'touch', 'restore')
+
+    def _run_one(self, action, path):
+        """run action on path, and describe how it went as a Result"""
+        method = getattr(self, '_{}_path'.format(action))
+        start = time.monotonic()
+        try:
+            with stats.timer(action):
+                # judged where the file really is, e.g. under another root
+                external_path = self.resolve_external_path(path)
+                if external_path is None or utils.writable(external_path):
+                    method(path)
+                else:
+                    # straight to the privileged helper, without failing unprivileged first
+                    with sudolib.elevated():
+                        method(path)
+            (outcome, reason) = (OK, None)
+        except OperationError as err:
+            (outcome, reason) = (FAILED, str(err))
+        except Exception as err:
+            logger.error('Error while running %s on %s', action, path, exc_info=True)
+            (outcome, reason) = (FAILED, 'Unexpected error: {!r}'.format(err))
+        return Result(path, action, outcome, reason, time.monotonic() - start)
+
+    def iter_results(self, action, paths, jobs=1):
+        """Run action on every path from the iterable paths, yields a Result as soon as each is done.
+
+        paths are consumed lazily and only a couple of them per worker are in flight, so memory
+        stays flat however many there are. With more than one job, results come in the order
+        they finish. Everything is one batch, committed when the generator is exhausted or closed."""
+        if action not in self.ACTIONS:
+            raise ValueError('Unknown action: {}'.format(action))
+        with self.batch():
+            if jobs <= 1:
+                for path in paths:
+                    yield self._run_one(action, path)
+                return
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                pending = set()
+                for path in paths:
+                    pending.add(pool.submit(self._run_one, action, path))
+                    if len(pending) >= 2 * jobs:
+                        (done, pending) = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            yield future.result()
+                for future in concurrent.futures.as_completed(pending):
+                    yield future.result()
+
+    def iter_collect(self, paths, jobs=1):
+        """collect every path, see iter_results"""
+        return self.iter_results('collect', paths, jobs)
+
+    def iter_drop(self, paths, jobs=1):
+        """drop every path, see iter_results"""
+        return self.iter_results('drop', paths, jobs)
+
+    def iter_project(self, paths, jobs=1):
+        """project every path, see iter_results"""
+        return self.iter_results('project', paths, jobs)
+
+    def iter_materialize(self, paths, jobs=1):
+        """materialize every path, see iter_results"""
+        return self.iter_results('materialize', paths, jobs)
+
+    def iter_touch(self, paths):
+        """touch every path one after another, as each opens an editor, see iter_results"""
+        return self.iter_results('touch', paths)
+
+    def _known_external_paths(self):
+        """external paths of files as recorded in the index, keyed by internal path"""
+        return {entry.internal_path: entry.external_path for entry in list(self.index.entries.values())}
+
+    def _iter_operations(self):
+        """yield operation objects for every file in the reality marble"""
+        known = self._known_external_paths()
+        for ph in self.phantasms:
+            opers = list(self._merged_view()[ph].values()) if ph in self._layered else ph.iter_operations(known)
+            for oper in opers:
+                # the file belongs to a more specific phantasm outside
+                if next(self._phantasm_index.matches(oper.external_path), None) is not ph:
+                    logger.warning('Skip file shadowed by another phantasm: %s', oper.internal_path)
+                    continue
+                yield oper
+
+    def _status(self, oper):
+        """the state of oper, the internal file is only read again if it changed since it was recorded"""
+        entry = self.index.get(oper.internal_path)
+        recorded = None
+        if entry is not None and entry.hash is not None and self.index.fresh(oper.internal_path):
+            recorded = (entry.size, entry.hash)
+        return oper.status(recorded)
+
+    def status(self, jobs=8):
+        """Classify every file in the reality marble, yields (state, operation) pairs as soon as
+        they are available. The checks run on a thread pool, as joint paths may live on slow filesystems."""
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(self._status, oper): oper for oper in self._iter_operations()}
+            for future in concurrent.futures.as_completed(futures):
+                oper = futures[future]
+                try:
+                    state = future.result()
+                except OSError as err:
+                    logger.error('Cannot check %s: %s', oper.external_path, err)
+                    state = primitives.UNKNOWN
+                yield (state, oper)
+
+    def plan(self, paths=None, action='project'):
+        """Compute what action on paths would do, without touching the filesystem.
+        When paths is None, plan projecting every file in the reality marble.
+        Files that need nothing done are left out."""
+        result = planner.Plan()
+        if paths is None:
+            opers = self._iter_operations()
+        else:
+            opers = []
+            for path in paths:
+                resolved = self.resolve_external_path(path)
+                (score, oper) = self._match_phantasms(resolved) if resolved else (0, None)
+                if score == 0:
+                    result.items.append(planner.PlanItem(
+                        action, None, None, path, conflict='Not managed by the reality marble: {}'.format(path)))
+                    continue
+                opers.append(oper)
+        for oper in opers:
+            item = planner.plan_operation(action, oper)
+            if item.steps or item.conflict:
+                result.items.append(item)
+        return result
+
+    def _execute_item(self, item, recheck=False):
+        try:
+            return self._run_item(item, recheck)
+        except OperationError as err:
+            logger.error('%s', err)
+        except OSError as err:
+            logger.error('Error while running %s on %s: %s', item.action, item.external_path, err)
+        return False
+
+    def _run_item(self, item, recheck=False):
+        """carry out item, if recheck is set, only if planning it again still gives the same steps"""
+        if item.conflict:
+            raise OperationError(item.conflict)
+        if not item.steps:
+            return True
+        oper = item.operation()
+        if recheck:
+            fresh = planner.plan_operation(item.action, oper)
+            if (fresh.steps, fresh.conflict) != (item.steps, item.conflict):
+                raise OperationError('Changed since the plan was made, plan again: {}'.format(item.external_path))
+        run = {
+            'collect': self._collect,
+            'project': self._project,
+            'touch': self._touch,
+        }[item.action]
+        if item.needs_sudo:
+            with sudolib.elevated():
+                return run(oper)
+        return run(oper)
+
+    @_batched
+    def execute(self, plan):
+        """Carry out a plan computed earlier, returns if every item succeeded"""
+        failed = 0
+        for item in plan.items:
+            # the filesystem may have changed since the plan was made
+            if not self._execute_item(item, recheck=True):
+                failed += 1
+        logger.info('executed %d items, %d failed', len(plan.items), failed)
+        return failed == 0
+
+    @_batched
+    def apply(self, plan=None):
+        """Project every file in the reality marble that is missing or stale,
+        or carry out the given plan"""
+        if plan is not None:
+            return self.execute(plan)
+        if len(self.phantasms) == 0:
+            logger.error('No configured phantasm found.')
+            return False
+
+        projected = failed = 0
+        for oper in self._iter_operations():
+            if oper.projected():
+                # only files changed since last time get rehashed
+                try:
+                    self._record(oper)
+                except OSError as err:
+                    logger.warning('Cannot record %s: %s', oper.internal_path, err)
+                continue
+            if self._execute_item(planner.plan_project(oper)):
+                projected += 1
+            else:
+                failed += 1
+        logger.info('projected %d files, %d failed', projected, failed)
+        return failed == 0
+
+    def apply_to(self, roots, jobs=4, on_result=None):
+        """Project every file in the reality marble onto each of roots concurrently.
+
+        Files and their phantasms are resolved once and reused for all roots. Returns a list
+        of ApplyResult in the order of roots, on_result is called with each of them as soon
+        as its root is done."""
+        import concurrent.futures
+        items = [(oper.base_path, oper.internal_path, os.path.relpath(oper.external_path, self.root),
+                  oper.managed_paths) for oper in self._iter_operations()]
+        roots = [utils.canonical_path(root) for root in roots]
+        if any(not utils.is_sub(root, self.path) for root in roots):
+            logger.warning('Reality marble is outside of some roots, projected links only resolve outside of them')
+
+        def apply_one(root):
+            start = time.monotonic()
+            projected = skipped = failed = 0
+            for (base_path, internal_path, relpath, managed_paths) in items:
+                oper = primitives.operations(base_path, internal_path, os.path.join(root, relpath), root=root,
+                                             managed_paths=managed_paths)
+                if oper.projected():
+                    skipped += 1
+                elif self._execute_item(planner.plan_project(oper)):
+                    projected += 1
+                else:
+                    failed += 1
+            result = ApplyResult(root, projected, skipped, failed, time.monotonic() - start)
+            logger.info('%s: projected %d files, %d up to date, %d failed', root, projected, skipped, failed)
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        with self.batch():
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                return list(pool.map(apply_one, roots))
+
+    def gc(self):
+        """Remove objects no longer referenced by any file in the reality marble,
+        returns number of objects and bytes freed"""
+        referenced = set(entry.hash for entry in self.index.entries.values())
+        (count, size) = self.bases.gc(referenced)
+        if self.objects is not None and self.objects is not self.bases:
+            (objects_count, objects_size) = self.objects.gc(referenced)
+            count += objects_count
+            size += objects_size
+        return (count, size)
+
+    @_batched
+    def materialize(self, path):
+        return self._guarded(self._materialize_path, path)
 
+    def _materialize_path(self, path):
+        finished = False
+        oper = self._resolve(path, 'No matches found, this symlink is not managed by the reality marble: {}')
         if not oper.managed():
-            logger.error('Symlink target is outside of the reality marble: {}'.format(
-                oper.external_path))
-            return finished
+            raise OperationError('Symlink target is outside of the reality marble: {}'.format(oper.external_path))
 
-        logger.debug('materialize {} <= {}'.format(
-            oper.external_path, oper.internal_path))
+        logger.debug('materialize %s <= %s', oper.external_path, oper.internal_path)
+        jid = self.journal.begin('materialize', oper)
         try:
             oper.materialize_unchecked()
             finished = True
+            self._record(oper)
         except Exception as err:
-            logger.debug('Error while materializing file: {} <= {}'.format(
-                oper.external_path, oper.internal_path), exc_info=True)
+            logger.debug('Error while materializing file: %s <= %s',
+                         oper.external_path, oper.internal_path, exc_info=True)
+            if not finished:
+                raise OperationError('Error while materializing {}: {}'.format(oper.external_path, err)) from err
         finally:
+            self._invalidate(oper)
             if not finished:
                 # clean up
                 logger.info('roll back partially done operation for materialize')
+            self.journal.done(jid)
         return finished
 
+    @_batched
     def touch(self, path):
-        finished = False
-        if len(self.phantasms) == 0:
-            logger.error('No configured phantasm found.')
-            return finished
+        return self._guarded(self._touch_path, path)
 
-        path = self.resolve_external_path(path)
-        if not path:
-            return finished
-
-        (score, oper) = self._match_phantasms(path)
-        if score == 0:
-            logger.error(
-                'No matches found, this symlink is not managed by the reality marble.')
-            return finished
-
-        if primitives.exists(oper.internal_path):
-            logger.error('Existing file found in reality marble, try project instead: {}'.format(oper.internal_path))
-            return finished
-        if primitives.exists(oper.external_path):
-            logger.error('Existing file found, maybe you mean collect: {}'.format(oper.external_path))
-            return finished
+    def _touch_path(self, path):
+        oper = self._resolve(path, 'No matching phantasm found: {}')
+        item = planner.plan_touch(oper)
+        if item.conflict:
+            raise OperationError(item.conflict)
 
+        return self._touch(oper)
 
-        logger.debug('touching new file {}'.format(oper.internal_path))
+    def _touch(self, oper):
+        finished = False
+        logger.debug('touching new file %s', oper.internal_path)
+        jid = self.journal.begin('touch', oper)
         try:
             primitives.edit(oper.internal_path)
             oper.project_unchecked()
             finished = True
+            self._record(oper)
         except Exception as err:
-            logger.debug('Error while materializing file: {} <= {}'.format(
-                oper.external_path, oper.internal_path), exc_info=True)
+            logger.debug('Error while touching file: %s <= %s',
+                         oper.external_path, oper.internal_path, exc_info=True)
+            if not finished:
+                raise OperationError('Error while touching {}: {}'.format(oper.internal_path, err)) from err
         finally:
+            self._invalidate(oper)
             if not finished:
                 # clean up
                 logger.info('roll back partially done operation for touch')
                 primitives.unlink(oper.internal_path, force=True)
                 utils.rmdir(os.path.dirname(oper.internal_path),
                             stop_at=self.path, ignore_fail_on_non_empty=True)
+            self.journal.done(jid)
         return finished
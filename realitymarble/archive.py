@@ -0,0 +1,68 @@
+import logging
+import os
+
+from realitymarble import utils
+from realitymarble.backup import BACKUP_NAME
+from realitymarble.config import CONFIG_NAME
+from realitymarble.index import INDEX_NAME
+from realitymarble.objects import BASES_NAME, OBJECTS_NAME
+
+
+logger = logging.getLogger(__name__)
+
+
+COMPRESSIONS = ('gz', 'bz2', 'xz', 'none')
+
+
+def export_marble(marble, fileobj, compression='gz'):
+    """Write marble as a tar stream to fileobj: its config, the index, phantasm trees, objects, bases and backups.
+    Files are streamed in chunks, the archive is never held in memory.
+
+    Phantasm trees of layers inside the marble are exported with it, layers outside of it are not."""
+    import tarfile
+    mode = 'w|' if compression == 'none' else 'w|' + compression
+    names = [CONFIG_NAME, INDEX_NAME]
+    for ph in marble.phantasms:
+        for base_path in ph.managed_paths or [ph.base_path]:
+            if utils.is_sub(marble.path, base_path):
+                names.append(os.path.relpath(base_path, marble.path))
+    for layer in marble.layers:
+        if not utils.is_sub(marble.path, layer):
+            logger.warning('Layer %s is outside of the reality marble and not exported, '
+                           'it has to be copied along separately', layer)
+    names += [OBJECTS_NAME, BASES_NAME, BACKUP_NAME]
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for name in names:
+            path = os.path.join(marble.path, name)
+            if not os.path.lexists(path):
+                continue
+            logger.debug('exporting %s', path)
+            tar.add(path, arcname=name)
+
+
+def _check_member(member):
+    """reject anything that would end up outside of the reality marble"""
+    import tarfile
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name.split(os.sep)[0] == '..':
+        raise tarfile.TarError('Refusing to extract outside of the reality marble: {}'.format(member.name))
+    # a reality marble never needs symlinks, and a chain of them can lead anywhere
+    if not (member.isfile() or member.isdir() or member.islnk()):
+        raise tarfile.TarError('Refusing to extract special file or symlink: {}'.format(member.name))
+    if member.islnk():
+        target = os.path.normpath(member.linkname)
+        if os.path.isabs(target) or target.split(os.sep)[0] == '..':
+            raise tarfile.TarError('Refusing to extract link to outside: {}'.format(member.name))
+
+
+def import_marble(path, fileobj):
+    """Extract a marble exported by export_marble from fileobj into path"""
+    import tarfile
+    os.makedirs(path, exist_ok=True)
+    # the data filter of newer Pythons checks the same and more, on top of ours
+    options = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            _check_member(member)
+            logger.debug('importing %s', member.name)
+            tar.extract(member, path, set_attrs=True, **options)
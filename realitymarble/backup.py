@@ -0,0 +1,186 @@
+import collections
+import json
+import logging
+import os
+import stat
+import threading
+import time
+
+from realitymarble import primitives
+from realitymarble.instrument import stats
+from realitymarble.utils import content
+from realitymarble.utils import sudolib
+
+
+logger = logging.getLogger(__name__)
+
+
+BACKUP_NAME = 'backups'
+LOG_NAME = 'log'
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# fast and still good for text, backups are taken for every replaced file
+DEFAULT_LEVEL = 1
+
+
+# entries logged before the owner was recorded have no uid and gid
+BackupEntry = collections.namedtuple('BackupEntry', ['time', 'host', 'path', 'hash', 'size', 'mode', 'uid', 'gid'],
+                                     defaults=(None, None))
+BackupEntry.__doc__ = """A file replaced while projecting. path is where it was, as seen from inside
+the root it belonged to, so the same file backed up on different hosts has the same path"""
+
+
+def _compress(src, dest, level):
+    import gzip
+    with open(src, 'rb') as fsrc, gzip.open(dest, 'wb', compresslevel=level) as fdst:
+        for chunk in iter(lambda: fsrc.read(content.CHUNK_SIZE), b''):
+            fdst.write(chunk)
+
+
+@sudolib.retryWithSudo
+def _restore_unchecked(object_path, external_path, mode, uid=None, gid=None):
+    """replace external_path with the decompressed object, owned by uid and gid if known"""
+    import gzip
+    import tempfile
+    dest_dir = os.path.dirname(external_path)
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.{}.'.format(os.path.basename(external_path)))
+    try:
+        with gzip.open(object_path, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdst:
+            for chunk in iter(lambda: fsrc.read(content.CHUNK_SIZE), b''):
+                fdst.write(chunk)
+        if uid is not None:
+            try:
+                os.chown(tmp_path, uid, gid)
+            except PermissionError:
+                logger.debug('Cannot set owner of %s', external_path)
+        os.chmod(tmp_path, stat.S_IMODE(mode))
+        os.replace(tmp_path, external_path)
+    except BaseException:
+        primitives.unlink(tmp_path, force=True)
+        raise
+    return True
+
+
+class BackupStore(object):
+    """Compressed copies of external files replaced by projecting, stored by content hash
+    under backups/, with a log of what was backed up when, where and on which host.
+
+    Identical content is stored once, no matter how many files, hosts or runs it comes from.
+    Once the store grows beyond max_size bytes, objects not backed up or restored for the
+    longest time are evicted. Their log entries stay, but can't be restored anymore."""
+
+    def __init__(self, marble_path, max_size=DEFAULT_MAX_SIZE, level=DEFAULT_LEVEL):
+        self.path = os.path.join(marble_path, BACKUP_NAME)
+        self.log_path = os.path.join(self.path, LOG_NAME)
+        self.max_size = max_size
+        self.level = level
+        self.host = os.uname().nodename
+        self._size = None
+        self._lock = threading.Lock()
+
+    def object_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:] + '.gz')
+
+    def __contains__(self, digest):
+        return os.path.exists(self.object_path(digest))
+
+    def iter_objects(self):
+        """yield (object path, size, last used) of every object"""
+        for dirname in os.listdir(self.path) if os.path.isdir(self.path) else []:
+            subdir = os.path.join(self.path, dirname)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                st = os.stat(os.path.join(subdir, name))
+                yield (os.path.join(subdir, name), st.st_size, st.st_mtime)
+
+    def size(self):
+        """total size of stored objects in bytes"""
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for (_, size, _) in self.iter_objects())
+            return self._size
+
+    def add(self, path, logical_path):
+        """back up the file at path, logged as logical_path, returns its BackupEntry"""
+        st = os.stat(path)
+        digest = content.content_hash(path, st)
+        obj_path = self.object_path(digest)
+        if os.path.exists(obj_path):
+            # mark as recently used
+            os.utime(obj_path)
+        else:
+            # know the size before the new object is counted in
+            self.size()
+            os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+            tmp_path = '{}.{}.{}.tmp'.format(obj_path, os.getpid(), threading.get_ident())
+            try:
+                _compress(path, tmp_path, self.level)
+                os.replace(tmp_path, obj_path)
+            except BaseException:
+                primitives.unlink(tmp_path, force=True)
+                raise
+            stats.count('backup')
+            stored = os.path.getsize(obj_path)
+            with self._lock:
+                self._size += stored
+        entry = BackupEntry(time.time(), self.host, logical_path, digest, st.st_size, st.st_mode,
+                            st.st_uid, st.st_gid)
+        with self._lock:
+            with open(self.log_path, 'a') as flog:
+                flog.write(json.dumps(entry._asdict(), separators=(',', ':')) + '\n')
+        if self.max_size is not None and self.size() > self.max_size:
+            self.evict()
+        return entry
+
+    def evict(self):
+        """remove least recently used objects until the store fits in max_size,
+        returns number of objects and bytes freed"""
+        objects = sorted(self.iter_objects(), key=lambda obj: obj[2])
+        total = sum(size for (_, size, _) in objects)
+        count = freed = 0
+        for (obj_path, size, _) in objects:
+            if total - freed <= self.max_size:
+                break
+            logger.debug('evicting backup %s', obj_path)
+            primitives.unlink(obj_path, force=True)
+            count += 1
+            freed += size
+        with self._lock:
+            self._size = total - freed
+        if count:
+            logger.info('evicted %d backups, %d bytes freed', count, freed)
+        return (count, freed)
+
+    def entries(self, logical_path=None):
+        """log entries, oldest first, only those of logical_path if given"""
+        try:
+            with open(self.log_path) as flog:
+                for line in flog:
+                    try:
+                        entry = BackupEntry(**json.loads(line))
+                    except (ValueError, TypeError):
+                        logger.debug('Ignoring broken backup log entry: %r', line)
+                        continue
+                    if logical_path is None or entry.path == logical_path:
+                        yield entry
+        except FileNotFoundError:
+            return
+
+    def latest(self, logical_path, host=None):
+        """the most recent entry of logical_path backed up on host, this host by default"""
+        host = self.host if host is None else host
+        found = None
+        for entry in self.entries(logical_path):
+            if entry.host == host:
+                found = entry
+        return found
+
+    def restore(self, entry, external_path):
+        """put the content backed up as entry back at external_path"""
+        obj_path = self.object_path(entry.hash)
+        if not os.path.exists(obj_path):
+            raise FileNotFoundError('Backup of {} has been evicted'.format(entry.path))
+        os.utime(obj_path)
+        return _restore_unchecked(obj_path, external_path, entry.mode, entry.uid, entry.gid)
@@ -1,7 +1,14 @@
 import click
+import json
 import logging
+import time
 
-from realitymarble import RealityMarble
+from realitymarble import OK, RealityMarble
+from realitymarble import primitives
+from realitymarble import utils
+from realitymarble.archive import COMPRESSIONS, export_marble, import_marble
+from realitymarble.plan import PLANNERS, Plan
+from realitymarble.instrument import stats
 
 
 @click.group(invoke_without_command=True)
@@ -10,9 +17,18 @@ from realitymarble import RealityMarble
               help='Path to your reality marble, can also be specified by env variable REALITY_MARBLE',
               default='~/customizations', envvar='REALITY_MARBLE',
               type=click.Path(file_okay=False, writable=True, resolve_path=False))
+@click.option('--root', default='/', envvar='REALITY_MARBLE_ROOT',
+              help='Project onto the system mounted at this directory, e.g. a chroot or an image',
+              type=click.Path(file_okay=False, exists=True))
 @click.option('--debug', '-d', is_flag=True,
               help='Enable debug output')
-def main(ctx, reality_marble, debug):
+@click.option('--stats', 'show_stats', is_flag=True,
+              help='Report time spent per operation and counts of system calls and subprocesses')
+@click.option('--profile', type=click.Path(dir_okay=False, writable=True), default=None,
+              help='Write cProfile data to this file')
+@click.option('--dry-run', '-n', is_flag=True,
+              help='Print the plan of what would be done as JSON instead of doing it')
+def main(ctx, reality_marble, root, debug, show_stats, profile, dry_run):
     """
     Manage configuration files in your own reality marble
     and recreate your system by projecting them on top of an existing system.
@@ -20,65 +36,316 @@ def main(ctx, reality_marble, debug):
     logging.basicConfig(level=logging.WARNING,
                         format='%(name)10s - %(funcName)-18s - [%(levelname)5s]: %(message)s')
 
-    marble = RealityMarble(reality_marble)
+    if show_stats:
+        stats.enabled = True
+        ctx.call_on_close(lambda: click.echo(stats.report(), err=True))
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def dump():
+            profiler.disable()
+            profiler.dump_stats(profile)
+        ctx.call_on_close(dump)
+
     if not ctx.obj:
         ctx.obj = {}
-    ctx.obj['marble'] = marble
+    ctx.obj['path'] = reality_marble
+    ctx.obj['root'] = root
+    ctx.obj['dry_run'] = dry_run
     if debug:
         logging.getLogger().setLevel(logging.NOTSET)
+    if ctx.invoked_subcommand == 'import':
+        # the reality marble comes from the archive
+        return
+
+    marble = RealityMarble(reality_marble, root=root)
+    ctx.obj['marble'] = marble
+    if debug:
         marble.dump_config()
 
 
+def _print_plan(ctx, plan):
+    click.echo(plan.to_json())
+    if plan.conflicts:
+        ctx.exit(1)
+
+
+jobs_option = click.option('--jobs', '-j', default=8, show_default=True,
+                           help='Number of files processed concurrently')
+
+
+def files_options(func):
+    """FILES, or - to read them from standard input, and how results are reported"""
+    func = click.option('--json', 'as_json', is_flag=True,
+                        help='Output a JSON object per file with the outcome and why it failed')(func)
+    func = click.option('--null', '-0', is_flag=True,
+                        help='Paths read from standard input are separated by NUL instead of newlines')(func)
+    return click.argument('files', nargs=-1, type=click.Path())(func)
+
+
+def _read_paths(stream, sep):
+    """yield paths separated by sep from stream as they come in"""
+    pending = ''
+    for chunk in iter(lambda: stream.read(64 * 1024), ''):
+        parts = (pending + chunk).split(sep)
+        pending = parts.pop()
+        for path in parts:
+            if path:
+                yield path
+    if pending:
+        yield pending
+
+
+def _run_many(ctx, action, files, jobs, null=False, as_json=False):
+    """run action on all files and summarize, exits with non-zero status if any of them failed"""
+    if files == ('-',):
+        files = _read_paths(click.get_text_stream('stdin'), '\0' if null else '\n')
+    if ctx.obj['dry_run']:
+        if action not in PLANNERS:
+            raise click.UsageError('--dry-run is not supported by {}'.format(action))
+        _print_plan(ctx, ctx.obj['marble'].plan(list(files), action=action))
+        return
+    total = failed = 0
+    for result in ctx.obj['marble'].iter_results(action, files, jobs=jobs):
+        total += 1
+        if as_json:
+            click.echo(json.dumps(result._asdict()))
+        if result.outcome != OK:
+            failed += 1
+            if not as_json:
+                click.echo('Failed to {}: {}: {}'.format(action, result.path, result.reason), err=True)
+    if total > 1 or failed:
+        click.echo('{} succeeded, {} failed'.format(total - failed, failed), err=True)
+    if failed:
+        ctx.exit(1)
+
+
 @main.command()
 @click.pass_context
-@click.argument('files', nargs=-1, type=click.Path(dir_okay=False))
-def collect(ctx, files):
+@files_options
+@jobs_option
+def collect(ctx, files, jobs, null, as_json):
     """
-    Collect FILES into your reality marble.
+    Collect FILES into your reality marble, - reads them from standard input.
     """
-    for f in files:
-        ctx.obj['marble'].collect(f)
+    _run_many(ctx, 'collect', files, jobs, null, as_json)
 
 
 @main.command()
 @click.pass_context
-@click.argument('files', nargs=-1, type=click.Path(dir_okay=False))
-def drop(ctx, files):
+@files_options
+@jobs_option
+def drop(ctx, files, jobs, null, as_json):
     """
     Drop FILES from your reality marble, and do not manage them anymore.
     """
-    for f in files:
-        ctx.obj['marble'].drop(f)
+    _run_many(ctx, 'drop', files, jobs, null, as_json)
 
 
 @main.command()
 @click.pass_context
-@click.argument('files', nargs=-1, type=click.Path(dir_okay=False))
-def project(ctx, files):
+@files_options
+@jobs_option
+def project(ctx, files, jobs, null, as_json):
     """
     Project corresponding file in your reality marble onto FILES.
     """
-    for f in files:
-        ctx.obj['marble'].project(f)
+    _run_many(ctx, 'project', files, jobs, null, as_json)
+
+
+@main.command()
+@click.pass_context
+@click.option('--plan', 'plan_file', type=click.File('r'), default=None,
+              help='Carry out a plan saved from a dry run instead of computing one')
+def apply(ctx, plan_file):
+    """
+    Project every file in your reality marble that is missing or stale.
+    """
+    marble = ctx.obj['marble']
+    if ctx.obj['dry_run']:
+        _print_plan(ctx, marble.plan())
+        return
+    plan = Plan.from_json(plan_file.read()) if plan_file else None
+    if not marble.apply(plan):
+        ctx.exit(1)
+
+
+@main.command('apply-to')
+@click.pass_context
+@click.argument('roots', nargs=-1, required=True,
+                type=click.Path(file_okay=False, exists=True))
+@click.option('--jobs', '-j', default=4, show_default=True,
+              help='Number of roots projected concurrently')
+def apply_to(ctx, roots, jobs):
+    """
+    Project every file in your reality marble onto each of ROOTS, e.g. container root filesystems.
+    """
+    def report(result):
+        click.echo('{}: {} projected, {} up to date, {} failed in {:.2f}s'.format(
+            result.root, result.projected, result.skipped, result.failed, result.elapsed))
+
+    results = ctx.obj['marble'].apply_to(roots, jobs=jobs, on_result=report)
+    if any(result.failed for result in results):
+        ctx.exit(1)
 
 
 @main.command()
 @click.pass_context
-@click.argument('files', nargs=-1, type=click.Path(dir_okay=False))
-def materialize(ctx, files):
+def gc(ctx):
+    """
+    Remove unreferenced objects from the object store of your reality marble.
+    """
+    (count, size) = ctx.obj['marble'].gc()
+    click.echo('Removed {} objects, {} bytes freed'.format(count, size))
+
+
+@main.command()
+@click.pass_context
+@files_options
+@jobs_option
+def materialize(ctx, files, jobs, null, as_json):
     """
     Don't manage FILES anymore.
     """
-    for f in files:
-        ctx.obj['marble'].materialize(f)
+    _run_many(ctx, 'materialize', files, jobs, null, as_json)
+
+
+@main.command()
+@click.pass_context
+@files_options
+@click.option('--list', 'list_only', is_flag=True,
+              help='List backups of FILES taken on any host instead of restoring them')
+def restore(ctx, files, null, as_json, list_only):
+    """
+    Restore FILES as they were before projecting replaced them, from the latest backup taken on this host.
+    """
+    if not list_only:
+        _run_many(ctx, 'restore', files, 1, null, as_json)
+        return
+    for path in files:
+        for entry in ctx.obj['marble'].list_backups(path):
+            if as_json:
+                click.echo(json.dumps(entry._asdict()))
+            else:
+                click.echo('{} {:20} {:>10} {} {}'.format(
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.time)),
+                    entry.host, entry.size, entry.hash[:12], entry.path))
 
 
 @main.command()
 @click.pass_context
-@click.argument('files', nargs=-1, type=click.Path(dir_okay=False))
-def touch(ctx, files):
+@files_options
+def touch(ctx, files, null, as_json):
     """
     Create new configuration files managed by reality marble.
     """
-    for f in files:
-        ctx.obj['marble'].touch(f)
+    _run_many(ctx, 'touch', files, 1, null, as_json)
+
+
+@main.command()
+@click.pass_context
+@click.option('--json', 'as_json', is_flag=True,
+              help='Output one JSON object per line')
+@click.option('--jobs', '-j', default=8, show_default=True,
+              help='Number of paths checked concurrently')
+def status(ctx, as_json, jobs):
+    """
+    Show the state of every file in your reality marble.
+    Exits with non-zero status if any of them is not projected.
+    """
+    clean = True
+    for (state, oper) in ctx.obj['marble'].status(jobs=jobs):
+        clean = clean and state == primitives.PROJECTED
+        if as_json:
+            click.echo(json.dumps({
+                'state': state,
+                'external_path': oper.external_path,
+                'internal_path': oper.internal_path,
+            }))
+        else:
+            click.echo('{:10} {}'.format(state, oper.external_path))
+    if not clean:
+        ctx.exit(1)
+
+
+@main.command()
+@click.pass_context
+@click.option('--days', default=7.0, show_default=True,
+              help='Files modified within this many days are considered recent')
+@click.option('--all', '-a', 'show_all', is_flag=True,
+              help='List every unmanaged file, not only recent ones and those changed from package defaults')
+@click.option('--jobs', '-j', default=8, show_default=True,
+              help='Number of directories scanned concurrently')
+def discover(ctx, days, show_all, jobs):
+    """
+    Find files in joint paths that may be worth collecting into your reality marble.
+    """
+    from realitymarble.discover import discover as discover_files
+
+    since = time.time() - days * 24 * 3600
+    for candidate in discover_files(ctx.obj['marble'], since=since, jobs=jobs):
+        if candidate.changed:
+            state = 'changed'
+        elif candidate.recent:
+            state = 'recent'
+        elif show_all:
+            state = 'unmanaged'
+        else:
+            continue
+        click.echo('{:10} {}'.format(state, candidate.external_path))
+
+
+@main.command()
+@click.pass_context
+@click.option('--reproject', is_flag=True,
+              help='Project files again when they were replaced or removed')
+@click.option('--debounce', default=1.0, show_default=True,
+              help='Seconds to wait for a file to settle before checking it')
+def watch(ctx, reproject, debounce):
+    """
+    Watch files in your reality marble and report drift as it happens.
+    """
+    from realitymarble.watch import Watcher
+
+    def report(state, oper, action):
+        click.echo('{:10} {:12} {}'.format(state, action, oper.external_path))
+
+    watcher = Watcher(ctx.obj['marble'], reproject=reproject, debounce=debounce, on_event=report)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+@main.command('export')
+@click.pass_context
+@click.option('--output', '-o', type=click.File('wb'), default='-', show_default=True,
+              help='File to write the archive to')
+@click.option('--compression', '-z', type=click.Choice(COMPRESSIONS), default='gz', show_default=True,
+              help='Compression of the archive')
+def export_(ctx, output, compression):
+    """
+    Export your reality marble as a tar stream.
+    """
+    export_marble(ctx.obj['marble'], output, compression=compression)
+
+
+@main.command('import')
+@click.pass_context
+@click.option('--input', '-i', 'input_', type=click.File('rb'), default='-', show_default=True,
+              help='File to read the archive from')
+@click.option('--apply', 'then_apply', is_flag=True,
+              help='Project every file afterwards')
+def import_(ctx, input_, then_apply):
+    """
+    Import a reality marble from a tar stream created by export.
+    """
+    path = utils.canonical_path(ctx.obj['path'])
+    import_marble(path, input_)
+    # configuration has changed
+    marble = RealityMarble(path, root=ctx.obj['root'])
+    ctx.obj['marble'] = marble
+    if then_apply and not marble.apply():
+        ctx.exit(1)
@@ -0,0 +1,79 @@
+import json
+import logging
+import os
+
+from realitymarble import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+CONFIG_NAME = '.realitymarble'
+CACHE_NAME = '.realitymarble.cache'
+
+
+# bumped whenever the layout of the compiled table or how paths are resolved changes
+CACHE_VERSION = 4
+
+
+def compile_config(config, marble_path, root=os.sep):
+    """resolve every path in the parsed configuration, returns a table of plain values"""
+    # overlays stacked on top of the reality marble, the last one is the highest
+    layers = [utils.canonical_path(marble_path, layer) for layer in config.get('layers', [])]
+    phantasms = []
+    for ph in config['phantasms']:
+        phantasms.append({
+            'name': ph['name'],
+            'type': ph['type'],
+            'base_path': utils.canonical_path(marble_path, ph['name']),
+            # symlinks inside root point somewhere inside it, not on the host
+            'joint_path': utils.canonical_path(
+                utils.resolve_in_root(utils.rebase(ph['joint_path'], root), root), resolve_link=False),
+            'include': ph.get('include'),
+            'exclude': ph.get('exclude'),
+            'layer_paths': [utils.canonical_path(layer, ph['name']) for layer in layers],
+        })
+    return {
+        'layers': layers,
+        'phantasms': phantasms,
+        'object_store': config.get('object_store'),
+        'backup': config.get('backup', True),
+    }
+
+
+def _save(path, data):
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as fcache:
+            json.dump(data, fcache, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except OSError as err:
+        # e.g. a read-only reality marble, next time it's compiled again
+        logger.debug('Cannot write config cache %s: %s', path, err)
+
+
+def load(marble_path, root=os.sep):
+    """The compiled configuration of the reality marble at marble_path.
+
+    The table is cached next to the config file and reused as long as the config file's
+    mtime and size, the reality marble and root stay the same, which saves parsing and
+    resolving joint paths on every startup."""
+    config_path = os.path.join(marble_path, CONFIG_NAME)
+    cache_path = os.path.join(marble_path, CACHE_NAME)
+    st = os.stat(config_path)
+    key = [CACHE_VERSION, marble_path, root, st.st_mtime_ns, st.st_size]
+    try:
+        with open(cache_path) as fcache:
+            cached = json.load(fcache)
+        if cached.get('key') == key:
+            return cached['table']
+        logger.debug('Config cache is stale: %s', cache_path)
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        logger.debug('Ignoring corrupted config cache: %s', cache_path)
+
+    with open(config_path) as fconfig:
+        table = compile_config(json.load(fconfig), marble_path, root)
+    _save(cache_path, {'key': key, 'table': table})
+    return table
@@ -0,0 +1,126 @@
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import time
+
+from realitymarble import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+# local database of pacman, backup files of every installed package are listed with their md5
+PACMAN_DB = '/var/lib/pacman/local'
+
+
+Candidate = collections.namedtuple('Candidate', ['external_path', 'phantasm', 'mtime', 'recent', 'changed'])
+Candidate.__doc__ = """An unmanaged file found in a joint path. changed tells if it differs from
+the default shipped by its package, it's None when there is no known default"""
+
+
+def package_defaults(db_path=PACMAN_DB, root=os.sep):
+    """md5 of files as shipped by their packages, keyed by path, read from the %BACKUP% section
+    of every package in the pacman database. Empty if there is no such database."""
+    defaults = {}
+    try:
+        packages = os.listdir(db_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return defaults
+    for package in packages:
+        try:
+            with open(os.path.join(db_path, package, 'files')) as ffiles:
+                section = None
+                for line in ffiles:
+                    line = line.rstrip('\n')
+                    if line.startswith('%') and line.endswith('%'):
+                        section = line
+                    elif section == '%BACKUP%' and line:
+                        (path, md5) = line.rsplit('\t', 1)
+                        defaults[utils.rebase(os.sep + path, root)] = md5
+        except FileNotFoundError:
+            continue
+    return defaults
+
+
+def _md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _Scanner(object):
+    def __init__(self, marble, since, defaults):
+        self.marble = marble
+        self.since = since
+        self.defaults = defaults
+
+    def owner(self, path):
+        return next(self.marble._phantasm_index.matches(path), None)
+
+    def scan(self, ph, dirpath):
+        """scan one directory of phantasm ph, returns (candidates, subdirectories to scan)"""
+        candidates = []
+        subdirs = []
+        try:
+            it = os.scandir(dirpath)
+        except (FileNotFoundError, NotADirectoryError, PermissionError) as err:
+            logger.debug('Cannot scan %s: %s', dirpath, err)
+            return (candidates, subdirs)
+        # relative paths are built by hand, os.path.relpath is way too slow for every entry
+        prefix = os.path.relpath(dirpath, ph.joint_path)
+        prefix = '' if prefix == os.curdir else prefix + os.sep
+        with it:
+            for entry in it:
+                relpath = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if not ph.discoverable(relpath, True) or utils.is_sub(self.marble.path, entry.path) \
+                            or self.owner(entry.path) is not ph:
+                        # skip the whole subtree, it's excluded or belongs to someone else
+                        continue
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and ph.discoverable(relpath, False):
+                    # managed files are symlinks, and so are never candidates
+                    candidates.append(self._candidate(ph, entry))
+        return (candidates, subdirs)
+
+    def _candidate(self, ph, entry):
+        mtime = entry.stat(follow_symlinks=False).st_mtime
+        changed = None
+        md5 = self.defaults.get(entry.path)
+        if md5 is not None:
+            try:
+                changed = _md5(entry.path) != md5
+            except PermissionError:
+                logger.debug('Cannot read %s', entry.path)
+        return Candidate(entry.path, ph, mtime, self.since is not None and mtime >= self.since, changed)
+
+
+def discover(marble, since=None, jobs=8, db_path=PACMAN_DB):
+    """Walk joint paths of every phantasm in marble and yield a Candidate for each unmanaged file,
+    in no particular order. Files modified after the timestamp since are marked recent.
+
+    Directories are scanned on a pool of jobs threads. Subtrees excluded by a phantasm, the
+    reality marble itself and joint paths of more specific phantasms are never entered."""
+    scanner = _Scanner(marble, since, package_defaults(db_path, marble.root))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+        for ph in marble.phantasms:
+            if scanner.owner(ph.joint_path) is ph and os.path.isdir(ph.joint_path):
+                pending.add(pool.submit(scanner.scan, ph, ph.joint_path))
+        scanned = 0
+        start = time.monotonic()
+        while pending:
+            (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (candidates, subdirs) = future.result()
+                scanned += 1
+                for path in subdirs:
+                    ph = scanner.owner(path)
+                    pending.add(pool.submit(scanner.scan, ph, path))
+                for candidate in candidates:
+                    yield candidate
+        logger.info('scanned %d directories in %.2fs', scanned, time.monotonic() - start)
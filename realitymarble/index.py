@@ -0,0 +1,114 @@
+import collections
+import json
+import logging
+import os
+import stat
+import threading
+
+from realitymarble.instrument import stats
+from realitymarble.utils import content
+
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_NAME = '.realitymarble.index'
+
+
+IndexEntry = collections.namedtuple(
+    'IndexEntry', ['internal_path', 'external_path', 'phantasm', 'size', 'mtime_ns', 'inode', 'hash'])
+
+
+class StateIndex(object):
+    """A compact record of every file managed by a reality marble, much like git's index.
+    Entries remember stat data of the internal file, so content hashes are only recomputed
+    for files that changed since they were recorded."""
+    VERSION = 1
+
+    def __init__(self, marble_path):
+        self.marble_path = marble_path
+        self.path = os.path.join(marble_path, INDEX_NAME)
+        self.entries = {}
+        self.dirty = False
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(self.path) as findex:
+                data = json.load(findex)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning('Ignoring corrupted index file: %s', self.path)
+            return
+        if data.get('version') != self.VERSION:
+            logger.warning('Ignoring index file of unknown version: %s', self.path)
+            return
+        for item in data['entries']:
+            entry = IndexEntry(os.path.join(self.marble_path, item[0]), *item[1:])
+            self.entries[entry.internal_path] = entry
+
+    def save(self):
+        """write the index back if anything changed, the file is replaced atomically"""
+        with self._lock:
+            if not self.dirty:
+                return
+            data = {
+                'version': self.VERSION,
+                'entries': [[os.path.relpath(entry.internal_path, self.marble_path)] + list(entry[1:])
+                            for entry in self.entries.values()]
+            }
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as findex:
+                json.dump(data, findex, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+    def get(self, internal_path):
+        return self.entries.get(internal_path)
+
+    def record(self, oper, st=None):
+        """record the operation's internal file, rehash it only if its stat data changed"""
+        if st is None:
+            stats.count('stat')
+            st = os.stat(oper.internal_path)
+        with self._lock:
+            entry = self.entries.get(oper.internal_path)
+        if entry is not None and self._fresh(entry, st):
+            digest = entry.hash
+        elif stat.S_ISDIR(st.st_mode):
+            # a whole directory managed by one symlink
+            digest = None
+        else:
+            digest = content.content_hash(oper.internal_path, st)
+        new_entry = IndexEntry(oper.internal_path, oper.external_path,
+                               os.path.basename(os.path.normpath(oper.base_path)),
+                               st.st_size, st.st_mtime_ns, st.st_ino, digest)
+        with self._lock:
+            if new_entry != entry:
+                self.entries[oper.internal_path] = new_entry
+                self.dirty = True
+        return new_entry
+
+    def remove(self, internal_path):
+        with self._lock:
+            if self.entries.pop(internal_path, None) is not None:
+                self.dirty = True
+
+    @staticmethod
+    def _fresh(entry, st):
+        return (entry.size, entry.mtime_ns, entry.inode) == (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def fresh(self, internal_path):
+        """if the recorded stat data still matches the internal file"""
+        entry = self.get(internal_path)
+        if entry is None:
+            return False
+        stats.count('stat')
+        try:
+            return self._fresh(entry, os.stat(internal_path))
+        except FileNotFoundError:
+            return False
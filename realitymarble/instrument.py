@@ -0,0 +1,77 @@
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+
+class Stats(object):
+    """Counters and timers of where reality marble spends its time.
+    Nothing is recorded unless enabled, so instrumented code paths stay cheap."""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = collections.Counter()
+            self.timings = collections.Counter()
+            self.calls = collections.Counter()
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.timings[name] += seconds
+            self.calls[name] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """time the block as one call of name"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """decorator timing every call of the function as name"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'operations': {name: {'calls': self.calls[name], 'seconds': self.timings[name]}
+                               for name in self.timings},
+            }
+
+    def report(self):
+        """human readable summary"""
+        data = self.as_dict()
+        lines = ['{:24} {:>8} {:>12}'.format('operation', 'calls', 'seconds')]
+        for (name, item) in sorted(data['operations'].items()):
+            lines.append('{:24} {:>8} {:>12.6f}'.format(name, item['calls'], item['seconds']))
+        lines.append('{:24} {:>8}'.format('counter', 'count'))
+        for (name, value) in sorted(data['counters'].items()):
+            lines.append('{:24} {:>8}'.format(name, value))
+        return '\n'.join(lines)
+
+
+# statistics of the whole process
+stats = Stats()
@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+JOURNAL_NAME = '.realitymarble.journal'
+
+
+def _device(path):
+    """the filesystem path is on, judged by its nearest existing parent, as (device, that parent)"""
+    while True:
+        try:
+            return (os.stat(path).st_dev, path)
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise
+            path = parent
+
+
+def _syncfs(path):
+    """flush the whole filesystem path is on to disk"""
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(libc, 'syncfs'):
+        os.sync()
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as err:
+        logger.debug('Cannot sync %s: %s', path, err)
+        return
+    try:
+        if libc.syncfs(fd) != 0:
+            logger.debug('Cannot sync %s: %s', path, os.strerror(ctypes.get_errno()))
+    finally:
+        os.close(fd)
+
+
+class Journal(object):
+    """A write-ahead log of the multi-step operations in a batch.
+
+    Every operation is recorded before it touches the filesystem and marked done
+    afterwards. Records are flushed to the kernel right away so they survive a crash
+    of the process, but durability is only requested when the batch commits, with one
+    sync per filesystem touched instead of one per file. Whatever is still pending in the journal when the marble
+    is opened next time was interrupted and needs recovery.
+
+    While a batch is open, the process holds an exclusive lock on the reality marble,
+    so pending records of a live process are never mistaken for a crash."""
+
+    def __init__(self, marble_path):
+        self.marble_path = marble_path
+        self.path = os.path.join(marble_path, JOURNAL_NAME)
+        self._file = None
+        self._next_id = 0
+        # a directory on every filesystem touched in this batch, keyed by device
+        self._filesystems = {}
+        self._lock_fd = None
+        self._lock = threading.Lock()
+
+    def _acquire(self, blocking):
+        import fcntl
+        fd = os.open(self.marble_path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def try_lock(self):
+        """take the lock unless another process holds it, returns if it did.
+        It's held until the next commit or unlock."""
+        with self._lock:
+            return self._lock_fd is not None or self._acquire(blocking=False)
+
+    def unlock(self):
+        with self._lock:
+            self._unlock()
+
+    def _unlock(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+
+    def begin(self, action, oper):
+        """record that action is about to be performed on oper, returns an id to pass to done.
+        The first record of a batch waits for other processes to finish theirs."""
+        with self._lock:
+            if self._file is None:
+                if self._lock_fd is None:
+                    self._acquire(blocking=True)
+                self._file = open(self.path, 'a')
+            jid = self._next_id
+            self._next_id += 1
+            self._write({
+                'id': jid,
+                'action': action,
+                'base_path': oper.base_path,
+                'internal_path': oper.internal_path,
+                'external_path': oper.external_path,
+                'root': oper.root,
+                'managed_paths': oper.managed_paths,
+            })
+            self._touch(oper.internal_path, oper.external_path)
+            return jid
+
+    def _touch(self, *paths):
+        for path in paths:
+            try:
+                (dev, parent) = _device(os.path.dirname(path))
+            except OSError as err:
+                logger.debug('Cannot find filesystem of %s: %s', path, err)
+                continue
+            self._filesystems.setdefault(dev, parent)
+
+    def done(self, jid):
+        with self._lock:
+            self._write({'done': jid})
+
+    def commit(self, *paths):
+        """make every file touched in this batch and paths durable with one sync per filesystem,
+        then discard the journal and release the lock"""
+        with self._lock:
+            if self._file is None:
+                self._unlock()
+                return
+            self._file.close()
+            self._file = None
+            self._next_id = 0
+            self._touch(self.path, *paths)
+            for path in self._filesystems.values():
+                _syncfs(path)
+            self._filesystems.clear()
+            os.unlink(self.path)
+            self._unlock()
+
+    def pending(self):
+        """records of operations that were started but never marked done"""
+        records = {}
+        try:
+            with open(self.path) as fjournal:
+                for line in fjournal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write at the end of the journal
+                        logger.debug('Ignoring broken journal record: %r', line)
+                        continue
+                    if 'done' in record:
+                        records.pop(record['done'], None)
+                    else:
+                        records[record['id']] = record
+        except FileNotFoundError:
+            pass
+        return list(records.values())
@@ -0,0 +1,107 @@
+import logging
+import os
+
+from realitymarble import primitives
+from realitymarble.utils import content
+
+
+logger = logging.getLogger(__name__)
+
+
+OBJECTS_NAME = 'objects'
+# base versions for merging, kept apart from objects when those are hardlinked
+BASES_NAME = 'bases'
+
+
+class ObjectStore(object):
+    """Content-addressed storage inside a reality marble. Each distinct content is stored
+    once under objects/<hash>, files in phantasms are laid out as links to those objects.
+
+    Reflinks share data until either side is written, but need a CoW filesystem, otherwise
+    they degrade to plain copies. With hardlinks, files of the same content also share mode
+    and owner, and editing one in place changes all of them and the object as well, so
+    hardlinks are only for marbles whose files are never edited through their links."""
+
+    LINK_MODES = ('hardlink', 'reflink')
+
+    def __init__(self, marble_path, link='reflink', name=OBJECTS_NAME):
+        if link not in self.LINK_MODES:
+            raise ValueError('Unknown link mode for object store: {}'.format(link))
+        self.path = os.path.join(marble_path, name)
+        self.link_mode = link
+        self._reflinks = None
+
+    def object_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def __contains__(self, digest):
+        return os.path.exists(self.object_path(digest))
+
+    def find(self, path):
+        """the hash of path if its content is already stored, otherwise None"""
+        digest = content.content_hash(path)
+        return digest if digest in self else None
+
+    def add(self, src):
+        """store the content of src, returns its hash"""
+        digest = content.content_hash(src)
+        obj_path = self.object_path(digest)
+        if os.path.exists(obj_path) and content.content_hash(obj_path) == digest:
+            return digest
+        # missing, or modified in place through a hardlink, replacing it also breaks the link
+        primitives.copy(src, obj_path)
+        return digest
+
+    def link(self, digest, dest):
+        """lay out the object at dest"""
+        obj_path = self.object_path(digest)
+        if self.link_mode == 'reflink':
+            if self._reflinks is None:
+                self._reflinks = self._probe_reflinks(obj_path)
+            primitives.copy(obj_path, dest)
+            return
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(dest, os.getpid())
+        try:
+            os.link(obj_path, tmp_path)
+        except OSError:
+            # e.g. crossing filesystems
+            logger.debug('Cannot hardlink %s, copying instead', obj_path, exc_info=True)
+            primitives.copy(obj_path, dest)
+            return
+        os.replace(tmp_path, dest)
+
+    def _probe_reflinks(self, obj_path):
+        """if the filesystem of the store can share data between files, warns if it can't"""
+        if primitives.supports_clone(obj_path, self.path):
+            return True
+        logger.warning('The filesystem of %s does not support reflinks, every file is stored twice. '
+                       'Set "link": "hardlink" for the object store to share them, '
+                       'if files are never edited through their links.', self.path)
+        return False
+
+    def iter_objects(self):
+        for dirname in os.listdir(self.path) if os.path.isdir(self.path) else []:
+            subdir = os.path.join(self.path, dirname)
+            for name in os.listdir(subdir):
+                yield (dirname + name, os.path.join(subdir, name))
+
+    def gc(self, referenced):
+        """remove objects whose hash is not in referenced and that no file links to,
+        returns number of objects and bytes freed"""
+        count = size = 0
+        for (digest, obj_path) in self.iter_objects():
+            if digest in referenced:
+                continue
+            st = os.lstat(obj_path)
+            if st.st_nlink > 1:
+                continue
+            logger.debug('removing unreferenced object %s', digest)
+            primitives.unlink(obj_path)
+            count += 1
+            size += st.st_size
+            try:
+                os.rmdir(os.path.dirname(obj_path))
+            except OSError:
+                pass
+        return (count, size)
@@ -0,0 +1,204 @@
+import json
+import os
+import stat
+
+from realitymarble import primitives
+from realitymarble import utils
+from realitymarble.instrument import stats
+from realitymarble.utils import content
+
+
+# kinds of steps in a plan
+MKDIR = 'mkdir'
+COPY = 'copy'
+EDIT = 'edit'
+UNLINK = 'unlink'
+MERGE = 'merge'
+SYMLINK = 'symlink'
+
+
+class PlanItem(object):
+    """What has to be done for one file: a list of (step, path, ...) tuples,
+    whether root is needed, and why it can't be done, if it can't"""
+
+    def __init__(self, action, base_path, internal_path, external_path,
+                 steps=None, needs_sudo=False, conflict=None, root=os.sep, managed_paths=None):
+        self.action = action
+        self.base_path = base_path
+        self.internal_path = internal_path
+        self.external_path = external_path
+        self.root = root
+        # base paths of the phantasm in every layer, None if it has no layers
+        self.managed_paths = managed_paths
+        self.steps = steps if steps is not None else []
+        self.needs_sudo = needs_sudo
+        self.conflict = conflict
+
+    def operation(self):
+        return primitives.operations(self.base_path, self.internal_path, self.external_path, root=self.root,
+                                     managed_paths=self.managed_paths)
+
+    def to_dict(self):
+        return {
+            'action': self.action,
+            'base_path': self.base_path,
+            'internal_path': self.internal_path,
+            'external_path': self.external_path,
+            'steps': [list(step) for step in self.steps],
+            'needs_sudo': self.needs_sudo,
+            'conflict': self.conflict,
+            'root': self.root,
+            'managed_paths': self.managed_paths,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data['steps'] = [tuple(step) for step in data['steps']]
+        return cls(**data)
+
+
+class Plan(object):
+    """Every step of a batch, computed without touching the filesystem,
+    so that it can be reviewed and executed later"""
+    VERSION = 1
+
+    def __init__(self, items=None):
+        self.items = items if items is not None else []
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def conflicts(self):
+        return [item for item in self.items if item.conflict]
+
+    def to_json(self):
+        """serialize as JSON, one item per line to keep it reviewable and diffable"""
+        items = ',\n'.join(json.dumps(item.to_dict(), separators=(',', ':')) for item in self.items)
+        return '{{"version":{},"items":[\n{}\n]}}'.format(self.VERSION, items)
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        if data.get('version') != cls.VERSION:
+            raise ValueError('Unknown plan version: {}'.format(data.get('version')))
+        return cls([PlanItem.from_dict(item) for item in data['items']])
+
+
+def _mkdir_steps(path):
+    """steps creating missing parent directories of path"""
+    missing = []
+    parent = os.path.dirname(path)
+    while parent:
+        stats.count('stat')
+        if os.path.isdir(parent):
+            break
+        missing.append((MKDIR, parent))
+        parent = os.path.dirname(parent)
+    return list(reversed(missing))
+
+
+def _lstat(path):
+    stats.count('lstat')
+    try:
+        return os.lstat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _item(action, oper):
+    managed_paths = oper.managed_paths if oper.managed_paths != [oper.base_path] else None
+    return PlanItem(action, oper.base_path, oper.internal_path, oper.external_path, root=oper.root,
+                    managed_paths=managed_paths)
+
+
+def plan_collect(oper):
+    item = _item('collect', oper)
+    st = _lstat(oper.external_path)
+    if st is None:
+        item.conflict = 'No such file: {}'.format(oper.external_path)
+    elif stat.S_ISLNK(st.st_mode):
+        item.conflict = 'Cannot collect a symlink: {}'.format(oper.external_path)
+    elif not stat.S_ISREG(st.st_mode):
+        item.conflict = 'Not a regular file: {}'.format(oper.external_path)
+    elif primitives.exists(oper.internal_path):
+        item.conflict = 'Existing files found in the reality marble, try project instead: {}'.format(
+            oper.internal_path)
+    else:
+        item.steps = _mkdir_steps(oper.internal_path) + [
+            (COPY, oper.external_path, oper.internal_path),
+            (UNLINK, oper.external_path),
+            (SYMLINK, oper.external_path, oper.internal_path),
+        ]
+        item.needs_sudo = not utils.writable(oper.external_path)
+    return item
+
+
+def plan_project(oper):
+    item = _item('project', oper)
+    stats.count('stat')
+    try:
+        mode = os.stat(oper.internal_path).st_mode
+    except FileNotFoundError:
+        mode = 0
+    is_dir = stat.S_ISDIR(mode)
+    if not is_dir and not stat.S_ISREG(mode):
+        item.conflict = 'Not a regular file in the reality marble: {}'.format(oper.internal_path)
+        return item
+    st = _lstat(oper.external_path)
+    if st is None:
+        item.steps = _mkdir_steps(oper.external_path)
+    elif stat.S_ISLNK(st.st_mode):
+        if oper.projected():
+            # nothing to do
+            return item
+        if not oper.managed():
+            item.conflict = 'External file is a symlink to somewhere else: {}'.format(oper.external_path)
+            return item
+        # projected from another layer, relink
+        item.steps = [(UNLINK, oper.external_path)]
+    elif os.path.realpath(oper.external_path) == os.path.realpath(oper.internal_path):
+        # projected as part of a whole directory
+        return item
+    elif is_dir or not stat.S_ISREG(st.st_mode):
+        item.conflict = 'External file is not a regular file: {}'.format(oper.external_path)
+        return item
+    else:
+        try:
+            same = content.same_content(oper.external_path, oper.internal_path)
+        except OSError as err:
+            item.conflict = 'Cannot compare external file: {}'.format(err)
+            return item
+        if same:
+            item.steps = [(UNLINK, oper.external_path)]
+        else:
+            item.steps = [(MERGE, oper.external_path, oper.internal_path), (UNLINK, oper.external_path)]
+    item.steps.append((SYMLINK, oper.external_path, oper.internal_path))
+    item.needs_sudo = not utils.writable(oper.external_path)
+    return item
+
+
+def plan_touch(oper):
+    item = _item('touch', oper)
+    if primitives.exists(oper.internal_path):
+        item.conflict = 'Existing file found in reality marble, try project instead: {}'.format(oper.internal_path)
+    elif _lstat(oper.external_path) is not None:
+        item.conflict = 'Existing file found, maybe you mean collect: {}'.format(oper.external_path)
+    else:
+        item.steps = (_mkdir_steps(oper.internal_path) + [(EDIT, oper.internal_path)] +
+                      _mkdir_steps(oper.external_path) + [(SYMLINK, oper.external_path, oper.internal_path)])
+        item.needs_sudo = not utils.writable(oper.external_path)
+    return item
+
+
+PLANNERS = {
+    'collect': plan_collect,
+    'project': plan_project,
+    'touch': plan_touch,
+}
+
+
+def plan_operation(action, oper):
+    """plan action on the file described by oper"""
+    return PLANNERS[action](oper)
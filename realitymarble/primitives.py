@@ -1,25 +1,128 @@
 import logging
 import os
-import shutil
-import subprocess
+import stat
+import threading
 
 from realitymarble import utils
+from realitymarble.instrument import stats
+from realitymarble.utils import content
 from realitymarble.utils import sudolib
 
 
 logger = logging.getLogger(__name__)
 
 
+# states of a managed external path
+PROJECTED = 'projected'
+MISSING = 'missing'
+REPLACED = 'replaced'
+DANGLING = 'dangling'
+ELSEWHERE = 'elsewhere'
+DRIFTED = 'drifted'
+# the external path could not be checked at all
+UNKNOWN = 'unknown'
+
+
 def exists(path):
     """check if path exists"""
+    stats.count('stat')
     return os.path.exists(path)
 
 
-def copy(src, dest):
+# ioctl request to share extents between two files, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def _clone(fsrc, fdst, size):
+    """make fdst share extents with fsrc, only works within a CoW filesystem like btrfs or XFS"""
+    import fcntl
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def supports_clone(src, directory):
+    """if files in directory can share extents with src"""
+    import tempfile
+    with tempfile.TemporaryFile(dir=directory) as fdst, open(src, 'rb') as fsrc:
+        try:
+            _clone(fsrc, fdst, 0)
+            return True
+        except OSError as err:
+            logger.debug('Cannot clone %s into %s: %s', src, directory, err)
+            return False
+
+
+def _copy_file_range(fsrc, fdst, size):
+    copied = 0
+    while copied < size:
+        sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+        if sent == 0:
+            break
+        copied += sent
+
+
+def _sendfile(fsrc, fdst, size):
+    copied = 0
+    while copied < size:
+        sent = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+        if sent == 0:
+            break
+        copied += sent
+
+
+def _copy_data(fsrc, fdst, size):
+    """copy data using the cheapest way the kernel allows"""
+    for method in (_clone, _copy_file_range, _sendfile):
+        if method is _copy_file_range and not hasattr(os, 'copy_file_range'):
+            continue
+        try:
+            method(fsrc, fdst, size)
+            return
+        except OSError:
+            logger.debug('%s not usable, falling back', method.__name__, exc_info=True)
+            # start over in case of partial data
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+    import shutil
+    shutil.copyfileobj(fsrc, fdst)
+
+
+def copy(src, dest, preserve_owner=True):
     """copy file from source to target, w.r.t. correct mode and owner for target.
-    Parent directories will be created."""
-    os.makedirs(os.path.dirname(dest), exist_ok=True)
-    return shutil.copyfile(src, dest)
+    Parent directories will be created. Data is copied in kernel when possible,
+    and target is replaced atomically.
+
+    The owner of source is kept if preserve_owner is True. Otherwise target keeps the owner
+    of the file it replaces, or belongs to the current user if there was none."""
+    import shutil
+    import tempfile
+    dest_dir = os.path.dirname(dest)
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.{}.'.format(os.path.basename(dest)))
+    try:
+        with open(src, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdst:
+            st = os.fstat(fsrc.fileno())
+            _copy_data(fsrc, fdst, st.st_size)
+        stats.count('copy')
+        stats.count('bytes_copied', st.st_size)
+        shutil.copystat(src, tmp_path)
+        owner = st
+        if not preserve_owner:
+            stats.count('lstat')
+            try:
+                owner = os.lstat(dest)
+            except FileNotFoundError:
+                owner = None
+        if owner is not None:
+            try:
+                os.chown(tmp_path, owner.st_uid, owner.st_gid)
+            except PermissionError:
+                logger.debug('Cannot set owner of %s', dest)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        unlink(tmp_path, force=True)
+        raise
+    return dest
 
 
 def unlink(path, force=False):
@@ -31,53 +134,120 @@ def unlink(path, force=False):
             raise
 
 
-def maybe_merge(src, dest):
-    """try merge source to target, if src exist. Returns if it's safe to overwrite src"""
-    if not os.path.exists(dest):
-        logger.error('Merging to a non-existing destination: {}'.format(dest))
+def remove(path):
+    """unlink path, or remove it with everything inside if it's a directory"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        import shutil
+        shutil.rmtree(path)
+    else:
+        unlink(path)
+
+
+def _copy_tree(src, dest):
+    """replace dest with a copy of the directory src, files belong to the current user"""
+    import shutil
+    import tempfile
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(dest), prefix='.{}.'.format(os.path.basename(dest)))
+    try:
+        shutil.copytree(src, tmp_path, symlinks=True, dirs_exist_ok=True,
+                        copy_function=lambda s, d: copy(s, d, preserve_owner=False))
+        # a directory can't be renamed over a symlink, the old one has to go first
+        unlink(dest, force=True)
+        os.rename(tmp_path, dest)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return dest
+
+
+def maybe_merge(src, dest, base=None):
+    """try merge source to target, if src exist. Returns if it's safe to overwrite src.
+    Changes in src since base are merged into dest in place, $EDITOR is only called
+    when they conflict with changes made in dest."""
+    stats.count('stat')
+    try:
+        dest_st = os.stat(dest)
+    except FileNotFoundError:
+        logger.error('Merging to a non-existing destination: %s', dest)
         return None
-    if not os.path.exists(src):
+    stats.count('lstat')
+    try:
+        src_st = os.lstat(src)
+    except FileNotFoundError:
         return True
 
-    if os.path.islink(src) or not os.path.isfile(src):
-        logger.error('Source is not a regular file: {}'.format(src))
+    if not stat.S_ISREG(src_st.st_mode):
+        logger.error('Source is not a regular file: %s', src)
         return False
-    if not os.path.isfile(dest):
-        logger.error('Destination is not a regular file: {}'.format(dest))
+    if not stat.S_ISREG(dest_st.st_mode):
+        logger.error('Destination is not a regular file: %s', dest)
         return False
 
-    diffcmd = ['diff', '-q', src, dest]
+    stats.count('compare')
     try:
-        res = subprocess.run(diffcmd, universal_newlines=True)
-        if res.returncode == 0:
+        if content.same_content(src, dest):
             # two files are the same
             return True
-    except subprocess.SubprocessError as err:
-        logger.exception(
-            'Error while execution of external program: {}'.format(' '.join(diffcmd)), err)
-        raise
+    except OSError as err:
+        logger.error('Cannot compare %s with %s: %s', src, dest, err)
+        return False
+
+    if base is None or not exists(base):
+        logger.error('No base version to merge %s into %s', src, dest)
+        return False
+    import shutil
+    import subprocess
+    import tempfile
+    from realitymarble.utils import merge
+    stats.count('merge')
+    (merged, conflicts) = merge.merge_files(base, dest, src)
+    # never write to dest in place, it may share its inode with an object
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.{}.'.format(os.path.basename(dest)))
+    try:
+        with os.fdopen(fd, 'wb') as fmerged:
+            fmerged.write(merged)
+        shutil.copymode(dest, tmp_path)
+        if conflicts:
+            logger.warning('%d conflicts merging %s into %s', conflicts, src, dest)
+            stats.count('merge.conflict')
+            try:
+                edit(tmp_path)
+            except (subprocess.SubprocessError, OSError) as err:
+                logger.error('Conflicts merging %s into %s are left unresolved: %s', src, dest, err)
+                return False
+        if not utils.resolve_conflict(tmp_path, dest):
+            return False
+    finally:
+        unlink(tmp_path, force=True)
+    return True
 
-    logger.warning('Calling external merge tool not implimented')
-    return False
+
+# there is only one terminal, concurrent operations take turns with the editor
+_editor_lock = threading.Lock()
 
 
 def edit(path):
     """use $EDITOR to edit file at path"""
+    import subprocess
     # make sure the path exists first
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
     editor = os.getenv('EDITOR', 'vim')
     cmd = [editor, path]
+    stats.count('subprocess.editor')
     try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError as err:
+        with _editor_lock:
+            subprocess.run(cmd, check=True)
+    except subprocess.CalledProcessError:
         logger.exception(
-            'Error while execution of external program: {}'.format(' '.join(cmd)), err)
+            'Error while execution of external program: %s', ' '.join(cmd))
         raise
 
 
 def move(src, dest):
     """move file from source to target"""
+    import shutil
     return shutil.move(src, dest)
 
 
@@ -86,7 +256,9 @@ def _project_unchecked(internal_path, external_path):
     """remove external_path then link external_path to internal_path"""
     finished = False
     try:
+        os.makedirs(os.path.dirname(external_path), exist_ok=True)
         unlink(external_path, force=True)
+        stats.count('symlink')
         os.symlink(internal_path, external_path)
         finished = True
     except Exception:
@@ -99,18 +271,96 @@ def _project_unchecked(internal_path, external_path):
     return finished
 
 
-def _managed(base_path, external_path):
+def link_target(internal_path, root=os.sep):
+    """what a symlink has to contain to reach internal_path when seen from inside root"""
+    if root != os.sep and utils.is_sub(root, internal_path):
+        return os.path.join(os.sep, os.path.relpath(internal_path, root))
+    return internal_path
+
+
+def resolve_link(external_path, target, root=os.sep):
+    """the path a symlink at external_path containing target refers to, when seen from inside root"""
+    if not os.path.isabs(target):
+        return os.path.normpath(os.path.join(os.path.dirname(external_path), target))
+    if root != os.sep:
+        return os.path.join(root, os.path.relpath(target, os.sep))
+    return target
+
+
+def _managed(base_path, external_path, root=os.sep):
     """check if the expternal path is managed"""
-    return os.path.islink(external_path) and utils.is_sub(base_path, os.readlink(external_path))
+    stats.count('lstat')
+    if not os.path.islink(external_path):
+        return False
+    stats.count('readlink')
+    return utils.is_sub(base_path, resolve_link(external_path, os.readlink(external_path), root))
+
+
+def _projected(internal_path, external_path):
+    """check if external_path is already a symlink to internal_path"""
+    stats.count('readlink')
+    try:
+        return os.readlink(external_path) == internal_path
+    except OSError:
+        return False
+
+
+def _status(base_path, internal_path, external_path, root=os.sep, recorded=None):
+    """classify the state of external_path w.r.t. internal_path. recorded is (size, hash)
+    of the internal file if they are known to be up to date, then it isn't read again"""
+    stats.count('lstat')
+    try:
+        st = os.lstat(external_path)
+    except FileNotFoundError:
+        return MISSING
+    if stat.S_ISLNK(st.st_mode):
+        stats.count('readlink')
+        target = resolve_link(external_path, os.readlink(external_path), root)
+        if not exists(target):
+            return DANGLING
+        if not utils.is_sub(base_path, target) or os.path.normpath(target) != os.path.normpath(internal_path):
+            return ELSEWHERE
+        return PROJECTED
+    if not stat.S_ISREG(st.st_mode):
+        return DRIFTED
+    if recorded is not None:
+        (size, digest) = recorded
+        if st.st_size == size and _hash(external_path, st) == digest:
+            return REPLACED
+        return DRIFTED
+    if _same_content(external_path, internal_path):
+        return REPLACED
+    return DRIFTED
+
+
+def _hash(path, st):
+    """content hash of path, None if it can't be read"""
+    try:
+        return content.content_hash(path, st)
+    except OSError as err:
+        logger.debug('Cannot hash %s: %s', path, err)
+        return None
+
+
+def _same_content(path1, path2):
+    """if two files have the same content, files that can't be read are considered different"""
+    try:
+        return content.same_content(path1, path2)
+    except OSError as err:
+        logger.debug('Cannot compare %s with %s: %s', path1, path2, err)
+        return False
 
 
 @sudolib.retryWithSudo
 def _materialize_unchecked(internal_path, external_path):
-    """remove external_path then copy internal_path to external_path"""
+    """replace external_path with a copy of internal_path, which may be a whole directory"""
     finished = False
     try:
-        unlink(external_path, force=True)
-        copy(internal_path, external_path)
+        if os.path.isdir(internal_path):
+            _copy_tree(internal_path, external_path)
+        else:
+            # the copy in the reality marble belongs to whoever collected it, not to the host
+            copy(internal_path, external_path, preserve_owner=False)
         finished = True
     except Exception:
         logger.debug('Failed with exception', exc_info=True)
@@ -124,16 +374,26 @@ def _materialize_unchecked(internal_path, external_path):
 
 class operations(object):
     """Operatoins"""
-    def __init__(self, base_path, internal_path, external_path):
+    def __init__(self, base_path, internal_path, external_path, root=os.sep, managed_paths=None):
         self.base_path = base_path
         self.internal_path = internal_path
         self.external_path = external_path
+        self.root = root
+        # links into any of these are ours, i.e. the same phantasm in every layer
+        self.managed_paths = managed_paths or [base_path]
+        self.link_target = link_target(internal_path, root)
 
     def project_unchecked(self):
-        return _project_unchecked(self.internal_path, self.external_path)
+        return _project_unchecked(self.link_target, self.external_path)
 
     def managed(self):
-        return _managed(self.base_path, self.external_path)
+        return any(_managed(base_path, self.external_path, self.root) for base_path in self.managed_paths)
+
+    def projected(self):
+        return _projected(self.link_target, self.external_path)
+
+    def status(self, recorded=None):
+        return _status(self.base_path, self.internal_path, self.external_path, self.root, recorded)
 
     def materialize_unchecked(self):
         return _materialize_unchecked(self.internal_path, self.external_path)
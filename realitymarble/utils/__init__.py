@@ -2,7 +2,7 @@ import errno
 import importlib
 import logging
 import os
-import shutil
+import re
 
 
 logger = logging.getLogger(__name__)
@@ -22,11 +22,62 @@ def canonical_path(path, *paths, **kwargs):
     return path
 
 
+def _components(path):
+    path = os.path.abspath(os.path.expanduser(path))
+    return [part for part in path.split(os.sep) if part]
+
+
+def rebase(path, root):
+    """move absolute path under root, as if root were /"""
+    path = os.path.abspath(os.path.expanduser(path))
+    if root == os.sep:
+        return path
+    return os.path.join(root, os.path.relpath(path, os.sep))
+
+
+def resolve_in_root(path, root):
+    """Resolve symlinks in path the way they resolve from inside root, as if root were /:
+    absolute link targets start at root, and .. never leaves it. path is inside root."""
+    if root == os.sep:
+        return os.path.realpath(path)
+    root = os.path.abspath(root)
+    pending = list(reversed(os.path.relpath(os.path.abspath(path), root).split(os.sep)))
+    resolved = []
+    links = 0
+    while pending:
+        part = pending.pop()
+        if part in ('', os.curdir):
+            continue
+        if part == os.pardir:
+            if resolved:
+                resolved.pop()
+            continue
+        current = os.path.join(root, *resolved, part)
+        if not os.path.islink(current):
+            resolved.append(part)
+            continue
+        links += 1
+        if links > 40:
+            raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+        target = os.readlink(current)
+        if os.path.isabs(target):
+            resolved = []
+        pending.extend(reversed(target.split(os.sep)))
+    return os.path.join(root, *resolved)
+
+
 def is_sub(parent, path):
-    """if path is considered inside parent path"""
-    parent = canonical_path(parent, resolve_link=False)
-    path = canonical_path(path, resolve_link=False)
-    return os.path.commonprefix([parent, path]) == parent
+    """if path is considered inside parent path, compared by path components without touching the filesystem"""
+    parent = _components(parent)
+    return _components(path)[:len(parent)] == parent
+
+
+def writable(path):
+    """if path can be created or replaced by the current user, judged by its nearest existing parent directory"""
+    parent = os.path.dirname(os.path.abspath(os.path.expanduser(path)))
+    while not os.path.isdir(parent):
+        parent = os.path.dirname(parent)
+    return os.access(parent, os.W_OK)
 
 
 def rmdir(path, stop_at='', ignore_fail_on_non_empty=False, continue_on_parent=True):
@@ -51,11 +102,46 @@ def rmdir(path, stop_at='', ignore_fail_on_non_empty=False, continue_on_parent=T
             break
 
 
+def walk_files(path):
+    """yield every non-directory entry under path, symlinks to directories are not followed"""
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        yield entry.path
+        except FileNotFoundError:
+            continue
+
+
+def compile_globs(patterns):
+    """Compile glob patterns into one regular expression matching paths relative to a directory.
+    Patterns without a slash match the name of an entry at any depth, like in .gitignore.
+    Returns None if there are no patterns."""
+    if not patterns:
+        return None
+    import fnmatch
+    parts = []
+    for pattern in patterns:
+        pattern = pattern.strip(os.sep)
+        prefix = '' if os.sep in pattern else '(?:.*{})?'.format(re.escape(os.sep))
+        parts.append(prefix + fnmatch.translate(pattern))
+    return re.compile('|'.join(parts))
+
+
 def import_by_name(name):
     parts = name.rsplit('.', 1)
     return getattr(importlib.import_module(parts[0]), parts[1])
 
 
 def resolve_conflict(file, target):
-    # TODO: resolve_conflict
-    return False
+    """replace target with file once it has no conflict markers left, returns if it did"""
+    from realitymarble.utils import merge
+    if merge.has_conflicts(file):
+        logger.error('Conflicts are left unresolved in %s', file)
+        return False
+    os.replace(file, target)
+    return True
@@ -0,0 +1,80 @@
+import collections
+import os
+import threading
+
+from realitymarble.instrument import stats
+
+
+CHUNK_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 16 * 1024 * 1024
+HASH_CACHE_SIZE = 4096
+
+
+_hash_cache = collections.OrderedDict()
+_hash_cache_lock = threading.Lock()
+
+
+def _signature(st):
+    """what has to stay unchanged for a cached hash to be valid"""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def content_hash(path, st=None):
+    """sha256 hex digest of the content of path, cached as long as the file's stat data doesn't change"""
+    if st is None:
+        stats.count('stat')
+        st = os.stat(path)
+    key = _signature(st)
+    with _hash_cache_lock:
+        if key in _hash_cache:
+            _hash_cache.move_to_end(key)
+            return _hash_cache[key]
+
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    result = digest.hexdigest()
+
+    with _hash_cache_lock:
+        _hash_cache[key] = result
+        if len(_hash_cache) > HASH_CACHE_SIZE:
+            _hash_cache.popitem(last=False)
+    return result
+
+
+def _same_chunks(f1, f2):
+    for chunk in iter(lambda: f1.read(CHUNK_SIZE), b''):
+        if chunk != f2.read(CHUNK_SIZE):
+            return False
+    return True
+
+
+def _same_mapped(f1, f2, size):
+    import mmap
+    with mmap.mmap(f1.fileno(), 0, access=mmap.ACCESS_READ) as m1, \
+            mmap.mmap(f2.fileno(), 0, access=mmap.ACCESS_READ) as m2:
+        for offset in range(0, size, CHUNK_SIZE):
+            if m1[offset:offset + CHUNK_SIZE] != m2[offset:offset + CHUNK_SIZE]:
+                return False
+    return True
+
+
+def same_content(path1, path2, use_hash=False):
+    """if two files have the same content. When use_hash is True, compare cached content hashes instead,
+    which pays off when the same file is compared again and again."""
+    stats.count('stat', 2)
+    st1 = os.stat(path1)
+    st2 = os.stat(path2)
+    if (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino):
+        return True
+    if st1.st_size != st2.st_size:
+        return False
+    if use_hash:
+        return content_hash(path1, st1) == content_hash(path2, st2)
+
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        if st1.st_size >= MMAP_THRESHOLD:
+            return _same_mapped(f1, f2, st1.st_size)
+        return _same_chunks(f1, f2)
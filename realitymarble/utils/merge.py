@@ -0,0 +1,117 @@
+import difflib
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+MARKER_OURS = b'<<<<<<< marble\n'
+MARKER_BASE = b'||||||| base\n'
+MARKER_SEP = b'=======\n'
+MARKER_THEIRS = b'>>>>>>> external\n'
+MARKERS = (MARKER_OURS, MARKER_BASE, MARKER_SEP, MARKER_THEIRS)
+
+
+def _common_prefix(base, ours, theirs):
+    end = min(len(base), len(ours), len(theirs))
+    i = 0
+    while i < end and base[i] == ours[i] == theirs[i]:
+        i += 1
+    return i
+
+
+def _common_suffix(base, ours, theirs, start):
+    end = min(len(base), len(ours), len(theirs)) - start
+    i = 0
+    while i < end and base[-1 - i] == ours[-1 - i] == theirs[-1 - i]:
+        i += 1
+    return i
+
+
+def _matching(base, other):
+    """map indices of lines in base to indices of the same lines in other"""
+    matcher = difflib.SequenceMatcher(None, base, other, autojunk=False)
+    mapping = {}
+    for (i, j, size) in matcher.get_matching_blocks():
+        for k in range(size):
+            mapping[i + k] = j + k
+    return mapping
+
+
+def _terminated(lines):
+    if lines and not lines[-1].endswith(b'\n'):
+        return lines[:-1] + [lines[-1] + b'\n']
+    return lines
+
+
+def _merge_chunk(base, ours, theirs, result):
+    """merge one chunk between two stable lines, returns if it conflicts"""
+    if ours == theirs or theirs == base:
+        result.extend(ours)
+    elif ours == base:
+        result.extend(theirs)
+    else:
+        result.append(MARKER_OURS)
+        result.extend(_terminated(ours))
+        result.append(MARKER_BASE)
+        result.extend(_terminated(base))
+        result.append(MARKER_SEP)
+        result.extend(_terminated(theirs))
+        result.append(MARKER_THEIRS)
+        return True
+    return False
+
+
+def merge3(base, ours, theirs):
+    """Three-way merge lists of lines, returns (merged lines, number of conflicts).
+    Conflicting chunks are kept in the result between diff3 style markers."""
+    if ours == theirs or theirs == base:
+        return (list(ours), 0)
+    if ours == base:
+        return (list(theirs), 0)
+
+    # only diff what is left after trimming lines unchanged in all three
+    head = _common_prefix(base, ours, theirs)
+    tail = _common_suffix(base, ours, theirs, head)
+    result = list(base[:head])
+    trailer = base[len(base) - tail:]
+    (base, ours, theirs) = [lines[head:len(lines) - tail] for lines in (base, ours, theirs)]
+    ours_matching = _matching(base, ours)
+    theirs_matching = _matching(base, theirs)
+
+    conflicts = 0
+    (i, o, t) = (0, 0, 0)
+    for bi in range(len(base) + 1):
+        if bi == len(base):
+            (oi, ti) = (len(ours), len(theirs))
+        elif bi in ours_matching and bi in theirs_matching:
+            (oi, ti) = (ours_matching[bi], theirs_matching[bi])
+        else:
+            continue
+        # a line unchanged on both sides, merge what's in between
+        if (bi, oi, ti) != (i, o, t):
+            conflicts += _merge_chunk(base[i:bi], ours[o:oi], theirs[t:ti], result)
+        if bi < len(base):
+            result.append(base[bi])
+        (i, o, t) = (bi + 1, oi + 1, ti + 1)
+    result.extend(trailer)
+    return (result, conflicts)
+
+
+def _read_lines(path):
+    with open(path, 'rb') as f:
+        return f.read().splitlines(keepends=True)
+
+
+def merge_files(base_path, ours_path, theirs_path):
+    """three-way merge the content of files, returns (merged content as bytes, number of conflicts)"""
+    (lines, conflicts) = merge3(*[_read_lines(path) for path in (base_path, ours_path, theirs_path)])
+    logger.debug('merged %s and %s with %d conflicts', ours_path, theirs_path, conflicts)
+    return (b''.join(lines), conflicts)
+
+
+def has_conflicts(path):
+    """if there are conflict markers left in path. Only the markers opening and closing
+    a conflict count, a separator line alone is common in ordinary files."""
+    with open(path, 'rb') as f:
+        return any(line == MARKER_OURS or line == MARKER_THEIRS for line in f)
@@ -0,0 +1,33 @@
+import os
+
+
+class PathTrie(object):
+    """A prefix tree over path components, used to find the longest registered prefix of a path"""
+
+    def __init__(self):
+        self._root = {}
+
+    @staticmethod
+    def _components(path):
+        return [part for part in path.split(os.sep) if part]
+
+    def insert(self, path, value):
+        """register value under path, multiple values under the same path are kept in insertion order"""
+        node = self._root
+        for part in self._components(path):
+            node = node.setdefault(part, {})
+        node.setdefault(None, []).append(value)
+
+    def matches(self, path):
+        """yield values registered under prefixes of path, longest prefix first"""
+        node = self._root
+        found = [node[None]] if None in node else []
+        for part in self._components(path):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node:
+                found.append(node[None])
+        for values in reversed(found):
+            for value in values:
+                yield value
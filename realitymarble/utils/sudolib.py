@@ -1,33 +1,179 @@
+import atexit
+import contextlib
+import functools
 import json
 import logging
-import subprocess
 import sys
+import threading
 
-from realitymarble.utils import canonical_path, import_by_name
+from realitymarble.instrument import stats
+from realitymarble.utils import import_by_name
 
 
 logger = logging.getLogger(__name__)
 
 
+class HelperError(RuntimeError):
+    """The privileged helper could not be reached or died unexpectedly"""
+    pass
+
+
+def _encode_exception(err):
+    """encode an exception raised in the helper so that it can be raised again on the other side"""
+    import traceback
+    clz = err.__class__
+    desc = {
+        'type': '.'.join([clz.__module__, clz.__qualname__]),
+        'args': [arg if isinstance(arg, (str, int, float, bool, type(None))) else repr(arg)
+                 for arg in err.args],
+        'traceback': traceback.format_exc(),
+    }
+    if isinstance(err, OSError):
+        desc['errno'] = err.errno
+        desc['strerror'] = err.strerror
+        desc['filename'] = err.filename
+        desc['filename2'] = err.filename2
+    return desc
+
+
+def _decode_exception(desc):
+    """recreate the exception described by desc"""
+    try:
+        clz = import_by_name(desc['type'])
+        if not (isinstance(clz, type) and issubclass(clz, Exception)):
+            raise TypeError(desc['type'])
+    except Exception:
+        return HelperError('{}: {}'.format(desc['type'], desc['args']))
+    if issubclass(clz, OSError) and desc.get('errno') is not None:
+        args = [desc['errno'], desc['strerror']]
+        if desc.get('filename') is not None:
+            args.append(desc['filename'])
+            if desc.get('filename2') is not None:
+                args += [0, desc['filename2']]
+        try:
+            return clz(*args)
+        except Exception:
+            pass
+    try:
+        return clz(*desc['args'])
+    except Exception:
+        return HelperError('{}: {}'.format(desc['type'], desc['args']))
+
+
+class Helper(object):
+    """A long-lived privileged process that executes functions on our behalf.
+
+    Requests and responses are exchanged as one JSON document per line over the
+    helper's stdin and stdout."""
+
+    def __init__(self, command=None):
+        if command is None:
+            command = ['sudo', sys.executable, '-m', 'realitymarble.utils.sudolib']
+        self.command = command
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        import subprocess
+        logger.info('starting privileged helper')
+        stats.count('subprocess.sudo')
+        self._proc = subprocess.Popen(self.command,
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      universal_newlines=True, bufsize=1)
+
+    def call(self, funcDesc, *args, **kwargs):
+        """execute funcDesc in the helper, returns whatever it returned or raises whatever it raised"""
+        stats.count('sudo_call')
+        msg = json.dumps({
+            'args': args,
+            'kwargs': kwargs,
+            'func': funcDesc
+        })
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self._start()
+            try:
+                self._proc.stdin.write(msg + '\n')
+                self._proc.stdin.flush()
+                line = self._proc.stdout.readline()
+            except (BrokenPipeError, OSError) as err:
+                self._reap()
+                raise HelperError('Lost connection to privileged helper') from err
+            if not line:
+                self._reap()
+                raise HelperError('Privileged helper exited unexpectedly')
+        logger.debug('Got response from helper: %s', line.rstrip())
+        response = json.loads(line)
+        if 'error' in response:
+            logger.debug('Exception in helper:\n%s', response['error'].get('traceback', ''))
+            raise _decode_exception(response['error'])
+        return response['result']
+
+    def _reap(self):
+        import subprocess
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        for stream in (proc.stdin, proc.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    def close(self):
+        """ask the helper to exit by closing its input, and wait for it"""
+        with self._lock:
+            if self._proc is not None:
+                logger.debug('shutting down privileged helper')
+                self._reap()
+
+
+_helper = None
+_helper_lock = threading.Lock()
+
+
+def helper():
+    """the helper shared by the whole process, started lazily"""
+    global _helper
+    with _helper_lock:
+        if _helper is None:
+            _helper = Helper()
+            atexit.register(_helper.close)
+        return _helper
+
+
 def sudo(funcDesc, *args, **kwargs):
     """execute a function using root user privilege, returns whatever func returned."""
-    msg = {
-        'args': args,
-        'kwargs': kwargs,
-        'func': funcDesc
-    }
-    result = subprocess.run(['sudo', sys.executable,
-                             canonical_path(__file__), json.dumps(msg)],
-                            stdout=subprocess.PIPE, universal_newlines=True)
-    logger.debug('Got stdout from subprocess: {}.'.format(result.stdout))
-    if len(result.stdout) > 0:
-        return json.loads(result.stdout)
+    return helper().call(funcDesc, *args, **kwargs)
+
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def elevated():
+    """within the context, functions decorated by retryWithSudo in this thread go to the
+    privileged helper directly, without trying and failing unprivileged first"""
+    previous = getattr(_local, 'elevated', False)
+    _local.elevated = True
+    try:
+        yield
+    finally:
+        _local.elevated = previous
 
 
 def retryWithSudo(func):
     funcDesc = '.'.join([func.__module__, func.__qualname__])
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        if getattr(_local, 'elevated', False):
+            return sudo(funcDesc, *args, **kwargs)
         try:
             result = func(*args, **kwargs)
         except PermissionError:
@@ -37,16 +183,27 @@ def retryWithSudo(func):
     return wrapper
 
 
-if __name__ == '__main__':
-    import importlib
+def serve(requests, responses):
+    """answer requests until requests is exhausted"""
+    for line in requests:
+        try:
+            msg = json.loads(line)
+            func = import_by_name(msg['func'])
+            # we are already privileged, don't retry with sudo again
+            func = getattr(func, '__wrapped__', func)
+            response = json.dumps({'result': func(*msg['args'], **msg['kwargs'])})
+        except Exception as err:
+            response = json.dumps({'error': _encode_exception(err)})
+        responses.write(response + '\n')
+        responses.flush()
 
-    def do(msg):
-        """decode msg passed in by sudo and actually execute the func"""
-        func = import_by_name(msg['func'])
-        return func(*msg['args'], **msg['kwargs'])
 
-    try:
-        msg = json.loads(sys.argv[1])
-        print(json.dumps(do(msg)))
-    except:
-        logger.exception("Exception in subprocess")
+if __name__ == '__main__':
+    import os
+
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(name)10s - %(funcName)-18s - [%(levelname)5s]: %(message)s')
+    # keep anything printed by called functions out of the response stream
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    sys.stdout = sys.stderr
+    serve(sys.stdin, responses)
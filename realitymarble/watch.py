@@ -0,0 +1,147 @@
+import collections
+import logging
+import os
+import time
+
+from realitymarble import plan as planner
+from realitymarble import primitives
+from realitymarble import utils
+from realitymarble.utils import inotify
+
+
+logger = logging.getLogger(__name__)
+
+
+# changes to a directory entry that may replace a projected symlink
+EXTERNAL_EVENTS = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM |
+                   inotify.IN_CLOSE_WRITE | inotify.IN_ATTRIB | inotify.IN_ONLYDIR)
+# changes to the set of files inside the reality marble
+INTERNAL_EVENTS = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM |
+                   inotify.IN_ONLYDIR)
+
+
+class Watcher(object):
+    """Watch managed files of a reality marble and react as soon as they drift.
+
+    Directories holding projected files, joint paths of phantasms and directories inside
+    the reality marble are watched. Events are debounced per path, as package managers
+    and editors usually touch a file several times in a row. Drifted files are re-projected
+    if reproject is set and it's safe to do so, otherwise queued in merge_queue."""
+
+    def __init__(self, marble, reproject=False, debounce=1.0, on_event=None):
+        self.marble = marble
+        self.reproject = reproject
+        self.debounce = debounce
+        self.on_event = on_event
+        self.merge_queue = collections.deque()
+        self._inotify = inotify.Inotify()
+        self._managed = {}
+        self._pending = {}
+        self._rebuild_due = None
+        self._rebuild()
+
+    def _watch(self, path, mask):
+        try:
+            self._inotify.add_watch(path, mask)
+        except OSError as err:
+            logger.warning('Cannot watch %s: %s', path, err)
+
+    def _base_paths(self):
+        """base paths of every phantasm in the reality marble and in its layers"""
+        paths = [ph.base_path for ph in self.marble.phantasms]
+        for stack in self.marble._layered.values():
+            paths.extend(layer.base_path for layer in stack[1:])
+        return paths
+
+    def _rebuild(self):
+        """rescan the reality marble and update the set of watches"""
+        logger.debug('rebuilding watches')
+        # files may have been added to or removed from layers
+        self.marble._forget_view()
+        self._managed = {oper.external_path: oper for oper in self.marble._iter_operations()}
+        external_dirs = set(os.path.dirname(path) for path in self._managed)
+        external_dirs.update(ph.joint_path for ph in self.marble.phantasms)
+        internal_dirs = set()
+        for base_path in self._base_paths():
+            for (dirpath, _, _) in os.walk(base_path):
+                internal_dirs.add(dirpath)
+
+        watched = self._inotify.watched()
+        for path in external_dirs - watched:
+            if os.path.isdir(path):
+                self._watch(path, EXTERNAL_EVENTS)
+        for path in internal_dirs - watched:
+            self._watch(path, INTERNAL_EVENTS)
+
+    def _is_internal(self, path):
+        return any(utils.is_sub(base_path, path) for base_path in self._base_paths())
+
+    def _schedule(self, path, now):
+        if path in self._managed:
+            self._pending[path] = now + self.debounce
+
+    def _handle(self, watched, mask, name, now):
+        if mask & inotify.IN_Q_OVERFLOW:
+            logger.warning('Event queue overflowed, rescanning every managed file')
+            for path in self._managed:
+                self._schedule(path, now)
+            return
+        if watched is None:
+            return
+        if self._is_internal(watched):
+            self._rebuild_due = now + self.debounce
+            return
+        path = os.path.join(watched, name) if name else watched
+        if mask & inotify.IN_ISDIR:
+            # new directories may hold managed files we couldn't watch before
+            self._rebuild_due = now + self.debounce
+        self._schedule(path, now)
+
+    def _check(self, path):
+        oper = self._managed.get(path)
+        if oper is None:
+            return
+        state = oper.status()
+        if state == primitives.PROJECTED:
+            return
+        action = 'reported'
+        if self.reproject and state in (primitives.MISSING, primitives.REPLACED, primitives.DANGLING):
+            # the planner refuses to replace what isn't ours, e.g. a dangling link of the user
+            with self.marble.batch():
+                action = 'reprojected' if self.marble._execute_item(planner.plan_project(oper)) else 'failed'
+        elif state == primitives.DRIFTED:
+            self.merge_queue.append(oper)
+            action = 'queued'
+        logger.info('%s is %s, %s', path, state, action)
+        if self.on_event is not None:
+            self.on_event(state, oper, action)
+
+    def poll(self, timeout=None):
+        """wait for events at most timeout seconds, then handle whatever is due"""
+        now = time.monotonic()
+        due = [t for t in list(self._pending.values()) + [self._rebuild_due] if t is not None]
+        if due:
+            wait = max(0, min(due) - now)
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        for (watched, mask, name) in self._inotify.read(timeout):
+            self._handle(watched, mask, name, time.monotonic())
+
+        now = time.monotonic()
+        if self._rebuild_due is not None and self._rebuild_due <= now:
+            self._rebuild_due = None
+            self._rebuild()
+        for path in [path for (path, t) in self._pending.items() if t <= now]:
+            del self._pending[path]
+            self._check(path)
+
+    def run(self):
+        """watch forever"""
+        try:
+            while True:
+                self.poll()
+        finally:
+            self.close()
+
+    def close(self):
+        self._inotify.close()
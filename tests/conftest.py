@@ -0,0 +1,30 @@
+import json
+
+import pytest
+from realitymarble import RealityMarble
+
+
+@pytest.fixture
+def joint(tmp_path):
+    path = tmp_path / 'host'
+    (path / 'etc').mkdir(parents=True)
+    (path / 'home' / '.local' / 'bin').mkdir(parents=True)
+    return path
+
+
+@pytest.fixture
+def marble(tmp_path, joint):
+    path = tmp_path / 'marble'
+    path.mkdir()
+    config = {
+        'phantasms': [
+            {'name': 'etc', 'type': 'realitymarble.Phantasm',
+             'joint_path': str(joint / 'etc')},
+            {'name': 'home', 'type': 'realitymarble.NoHiddenPhantasm',
+             'joint_path': str(joint / 'home')},
+            {'name': 'scripts', 'type': 'realitymarble.ScriptsPhantasm',
+             'joint_path': str(joint / 'home' / '.local' / 'bin')},
+        ]
+    }
+    (path / '.realitymarble').write_text(json.dumps(config))
+    return RealityMarble(str(path))
@@ -0,0 +1,75 @@
+import io
+import os
+import tarfile
+
+import pytest
+from realitymarble import RealityMarble
+from realitymarble.archive import export_marble, import_marble
+
+
+def test_roundtrip(marble, joint, tmp_path):
+    external = joint / 'etc' / 'fstab'
+    external.write_text('fstab')
+    assert marble.collect(str(external))
+
+    stream = io.BytesIO()
+    export_marble(marble, stream, compression='xz')
+    stream.seek(0)
+    target = tmp_path / 'imported'
+    import_marble(str(target), stream)
+
+    assert (target / 'etc' / 'fstab').read_text() == 'fstab'
+    imported = RealityMarble(str(target))
+    assert len(imported.phantasms) == 3
+    assert imported.index.get(os.path.join(imported.path, 'etc', 'fstab')).external_path == str(external)
+
+
+def test_export_layers(tmp_path, caplog):
+    import json
+    host = tmp_path / 'host' / 'etc'
+    host.mkdir(parents=True)
+    marble_path = tmp_path / 'common'
+    (marble_path / 'etc').mkdir(parents=True)
+    (marble_path / '.realitymarble').write_text(json.dumps({
+        'layers': ['layers/myhost', '../role'],
+        'phantasms': [{'name': 'etc', 'type': 'realitymarble.Phantasm', 'joint_path': str(host)}],
+    }))
+    for (layer, name) in ((marble_path, 'a'), (marble_path / 'layers' / 'myhost', 'b'), (tmp_path / 'role', 'c')):
+        (layer / 'etc').mkdir(parents=True, exist_ok=True)
+        (layer / 'etc' / name).write_text(name)
+
+    stream = io.BytesIO()
+    export_marble(RealityMarble(str(marble_path)), stream, compression='none')
+    stream.seek(0)
+    with tarfile.open(fileobj=stream) as tar:
+        names = tar.getnames()
+    assert 'etc/a' in names
+    assert 'layers/myhost/etc/b' in names
+    assert not [name for name in names if name.endswith('/c')]
+    assert str(tmp_path / 'role') in caplog.text
+
+
+def test_import_rejects_escaping_members(tmp_path):
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w:gz') as tar:
+        info = tarfile.TarInfo('../escaped')
+        tar.addfile(info, io.BytesIO())
+    stream.seek(0)
+    with pytest.raises(tarfile.TarError):
+        import_marble(str(tmp_path / 'imported'), stream)
+    assert not (tmp_path / 'escaped').exists()
+
+
+def test_import_rejects_symlink_chains(tmp_path):
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w:gz') as tar:
+        for (name, target) in (('b', '.'), ('c', 'b/..')):
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tar.addfile(info)
+        tar.addfile(tarfile.TarInfo('c/escaped'), io.BytesIO())
+    stream.seek(0)
+    with pytest.raises(tarfile.TarError):
+        import_marble(str(tmp_path / 'imported'), stream)
+    assert not (tmp_path / 'escaped').exists()
@@ -0,0 +1,78 @@
+import json
+import os
+
+import pytest
+from realitymarble.backup import BackupStore
+
+
+def test_add_deduplicates_and_logs(tmp_path):
+    store = BackupStore(str(tmp_path))
+    (tmp_path / 'a').write_text('same' * 1000)
+    (tmp_path / 'b').write_text('same' * 1000)
+    first = store.add(str(tmp_path / 'a'), '/etc/a')
+    second = store.add(str(tmp_path / 'b'), '/etc/b')
+    assert first.hash == second.hash
+    assert len(list(store.iter_objects())) == 1
+    # compressed
+    assert store.size() < 4000
+    assert [entry.path for entry in store.entries()] == ['/etc/a', '/etc/b']
+    assert store.latest('/etc/b') == second
+    assert store.latest('/etc/b', host='elsewhere') is None
+
+
+def test_restore(tmp_path):
+    store = BackupStore(str(tmp_path))
+    (tmp_path / 'a').write_text('original')
+    os.chmod(str(tmp_path / 'a'), 0o600)
+    entry = store.add(str(tmp_path / 'a'), '/a')
+    os.unlink(str(tmp_path / 'a'))
+    os.symlink('/nowhere', str(tmp_path / 'a'))
+
+    store.restore(entry, str(tmp_path / 'a'))
+    assert not os.path.islink(str(tmp_path / 'a'))
+    assert (tmp_path / 'a').read_text() == 'original'
+    assert os.stat(str(tmp_path / 'a')).st_mode & 0o777 == 0o600
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason='changing owners needs root')
+def test_restore_owner(tmp_path):
+    store = BackupStore(str(tmp_path))
+    (tmp_path / 'a').write_text('original')
+    os.chown(str(tmp_path / 'a'), 1234, 5678)
+    entry = store.add(str(tmp_path / 'a'), '/a')
+    os.unlink(str(tmp_path / 'a'))
+
+    store.restore(entry, str(tmp_path / 'a'))
+    st = os.stat(str(tmp_path / 'a'))
+    assert (st.st_uid, st.st_gid) == (1234, 5678)
+
+
+def test_entries_without_owner(tmp_path):
+    store = BackupStore(str(tmp_path))
+    (tmp_path / 'a').write_text('original')
+    entry = store.add(str(tmp_path / 'a'), '/a')
+    # logged before owners were recorded
+    old = {key: value for (key, value) in entry._asdict().items() if key not in ('uid', 'gid')}
+    with open(store.log_path, 'w') as flog:
+        flog.write(json.dumps(old) + '\n')
+    [logged] = store.entries()
+    assert (logged.uid, logged.gid) == (None, None)
+    os.unlink(str(tmp_path / 'a'))
+    store.restore(logged, str(tmp_path / 'a'))
+    assert (tmp_path / 'a').read_text() == 'original'
+
+
+def test_evicts_least_recently_used(tmp_path):
+    store = BackupStore(str(tmp_path), max_size=None)
+    entries = []
+    for (i, name) in enumerate(('old', 'used', 'new')):
+        (tmp_path / name).write_bytes(os.urandom(1000))
+        entries.append(store.add(str(tmp_path / name), '/' + name))
+        os.utime(store.object_path(entries[-1].hash), (i, i))
+    # backed up again later
+    os.utime(store.object_path(entries[1].hash), (10, 10))
+
+    store.max_size = store.size() - 1
+    assert store.evict()[0] == 1
+    assert entries[0].hash not in store
+    assert entries[1].hash in store and entries[2].hash in store
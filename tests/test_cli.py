@@ -27,3 +27,22 @@ def test_cli_with_arg(runner):
     assert result.exit_code == 0
     assert not result.exception
     assert result.output.strip() == 'Hello, Aetf.'
+
+
+def test_materialize_directory(runner, tmp_path):
+    import json
+    import os
+    marble_path = tmp_path / 'marble'
+    (marble_path / 'config' / 'nvim').mkdir(parents=True)
+    (marble_path / 'config' / 'nvim' / 'init.vim').write_text('init')
+    external = tmp_path / 'host' / '.config'
+    external.mkdir(parents=True)
+    (marble_path / '.realitymarble').write_text(json.dumps({'phantasms': [
+        {'name': 'config', 'type': 'realitymarble.DirectoryPhantasm', 'joint_path': str(external)},
+    ]}))
+    os.symlink(str(marble_path / 'config' / 'nvim'), str(external / 'nvim'))
+
+    result = runner.invoke(cli.main, ['-r', str(marble_path), 'materialize', str(external / 'nvim')])
+    assert result.exit_code == 0, result.output
+    assert not os.path.islink(str(external / 'nvim'))
+    assert (external / 'nvim' / 'init.vim').read_text() == 'init'
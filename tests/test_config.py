@@ -0,0 +1,45 @@
+import json
+import os
+
+from realitymarble import config
+
+
+def write_config(marble_path, joint_path):
+    (marble_path / config.CONFIG_NAME).write_text(json.dumps({'phantasms': [
+        {'name': 'etc', 'type': 'realitymarble.Phantasm', 'joint_path': str(joint_path)},
+    ]}))
+
+
+def test_load_resolves_paths(tmp_path):
+    (tmp_path / 'real').mkdir()
+    os.symlink(str(tmp_path / 'real'), str(tmp_path / 'link'))
+    write_config(tmp_path, tmp_path / 'link')
+    table = config.load(str(tmp_path))
+    assert table['phantasms'][0]['joint_path'] == str(tmp_path / 'real') + os.sep
+    assert table['phantasms'][0]['base_path'] == os.path.join(str(tmp_path), 'etc')
+    assert table['object_store'] is None
+
+
+def test_cache_reused_until_config_changes(tmp_path, monkeypatch):
+    write_config(tmp_path, tmp_path / 'a')
+    first = config.load(str(tmp_path))
+    assert (tmp_path / config.CACHE_NAME).exists()
+
+    def fail(*args, **kwargs):
+        raise AssertionError('config compiled again')
+    monkeypatch.setattr(config, 'compile_config', fail)
+    assert config.load(str(tmp_path)) == first
+    monkeypatch.undo()
+
+    write_config(tmp_path, tmp_path / 'bb')
+    st = os.stat(str(tmp_path / config.CONFIG_NAME))
+    os.utime(str(tmp_path / config.CONFIG_NAME), ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert config.load(str(tmp_path))['phantasms'][0]['joint_path'] == str(tmp_path / 'bb')
+    # and for a different root
+    assert config.load(str(tmp_path), '/mnt')['phantasms'][0]['joint_path'].startswith('/mnt/')
+
+
+def test_corrupted_cache_ignored(tmp_path):
+    write_config(tmp_path, tmp_path / 'a')
+    (tmp_path / config.CACHE_NAME).write_text('{broken')
+    assert config.load(str(tmp_path))['phantasms'][0]['name'] == 'etc'
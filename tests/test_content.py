@@ -0,0 +1,41 @@
+import os
+
+import pytest
+from realitymarble.utils import content
+
+
+@pytest.fixture(params=[False, True], ids=['chunked', 'hashed'])
+def use_hash(request):
+    return request.param
+
+
+def test_same_content(tmp_path, use_hash):
+    a = tmp_path / 'a'
+    b = tmp_path / 'b'
+    a.write_bytes(b'x' * 3000000)
+    b.write_bytes(b'x' * 3000000)
+    assert content.same_content(str(a), str(b), use_hash=use_hash)
+
+    b.write_bytes(b'x' * 2999999 + b'y')
+    assert not content.same_content(str(a), str(b), use_hash=use_hash)
+
+
+def test_size_mismatch(tmp_path):
+    (tmp_path / 'a').write_bytes(b'abc')
+    (tmp_path / 'b').write_bytes(b'abcd')
+    assert not content.same_content(str(tmp_path / 'a'), str(tmp_path / 'b'))
+
+
+def test_same_inode(tmp_path):
+    (tmp_path / 'a').write_bytes(b'abc')
+    os.link(str(tmp_path / 'a'), str(tmp_path / 'b'))
+    assert content.same_content(str(tmp_path / 'a'), str(tmp_path / 'b'))
+
+
+def test_mapped_compare(tmp_path, monkeypatch):
+    monkeypatch.setattr(content, 'MMAP_THRESHOLD', 1)
+    monkeypatch.setattr(content, 'CHUNK_SIZE', 7)
+    (tmp_path / 'a').write_bytes(b'0123456789' * 10)
+    (tmp_path / 'b').write_bytes(b'0123456789' * 9 + b'012345678x')
+    assert content.same_content(str(tmp_path / 'a'), str(tmp_path / 'a'))
+    assert not content.same_content(str(tmp_path / 'a'), str(tmp_path / 'b'))
@@ -0,0 +1,66 @@
+import json
+import os
+import time
+
+from realitymarble import RealityMarble
+from realitymarble.discover import discover, package_defaults
+
+
+def found(marble, base, **kwargs):
+    return {os.path.relpath(c.external_path, str(base)): c for c in discover(marble, **kwargs)}
+
+
+def test_discover_unmanaged_files(marble, joint, tmp_path):
+    (joint / 'etc' / 'fstab').write_text('fstab')
+    (joint / 'etc' / 'hosts').write_text('hosts')
+    assert marble.collect(str(joint / 'etc' / 'hosts'))
+    (joint / 'home' / '.bashrc').write_text('bashrc')
+    (joint / 'home' / 'Documents').mkdir()
+    (joint / 'home' / 'Documents' / 'notes').write_text('not a config')
+    (joint / 'home' / '.local' / 'bin' / 'tool').write_text('#!/bin/sh')
+    old = time.time() - 30 * 24 * 3600
+    os.utime(str(joint / 'etc' / 'fstab'), (old, old))
+
+    result = found(marble, joint, since=time.time() - 24 * 3600, db_path=str(tmp_path / 'nodb'))
+    assert sorted(result) == ['etc/fstab', 'home/.bashrc', 'home/.local/bin/tool']
+    assert not result['etc/fstab'].recent
+    assert result['home/.bashrc'].recent
+    assert result['home/.local/bin/tool'].phantasm.__class__.__name__ == 'ScriptsPhantasm'
+
+
+def test_discover_skips_marble_inside_joint_path(tmp_path):
+    home = tmp_path / 'home'
+    (home / '.customizations').mkdir(parents=True)
+    (home / '.customizations' / '.realitymarble').write_text(json.dumps({'phantasms': [
+        {'name': 'home', 'type': 'realitymarble.NoHiddenPhantasm', 'joint_path': str(home)},
+    ]}))
+    (home / '.vimrc').write_text('vimrc')
+    marble = RealityMarble(str(home / '.customizations'))
+    assert sorted(found(marble, home, db_path=str(tmp_path / 'nodb'))) == ['.vimrc']
+
+
+def test_discover_globs_and_package_defaults(tmp_path):
+    host = tmp_path / 'host' / 'etc'
+    (host / 'ssl' / 'certs').mkdir(parents=True)
+    (host / 'ssl' / 'certs' / 'ca.pem').write_text('cert')
+    (host / 'pacman.conf').write_text('changed')
+    (host / 'pacman.conf.pacnew').write_text('default')
+    (host / 'locale.gen').write_text('default')
+    path = tmp_path / 'marble'
+    path.mkdir()
+    (path / '.realitymarble').write_text(json.dumps({'phantasms': [
+        {'name': 'etc', 'type': 'realitymarble.Phantasm', 'joint_path': str(host),
+         'exclude': ['*.pacnew', 'ssl/certs']},
+    ]}))
+    db = tmp_path / 'db' / 'pacman-6.0-1'
+    db.mkdir(parents=True)
+    backup = ''.join('{}\t{}\n'.format(os.path.relpath(str(host / name), os.sep), md5) for (name, md5) in (
+        ('pacman.conf', 'c21f969b5f03d33d43e04f8f136e7682'), ('locale.gen', 'c21f969b5f03d33d43e04f8f136e7682')))
+    (db / 'files').write_text('%FILES%\netc/\n\n%BACKUP%\n' + backup)
+    assert len(package_defaults(str(tmp_path / 'db'))) == 2
+
+    marble = RealityMarble(str(path))
+    result = found(marble, host, db_path=str(tmp_path / 'db'))
+    assert sorted(result) == ['locale.gen', 'pacman.conf']
+    assert result['pacman.conf'].changed
+    assert result['locale.gen'].changed is False
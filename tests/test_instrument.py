@@ -0,0 +1,27 @@
+from realitymarble.instrument import Stats
+
+
+def test_disabled_records_nothing():
+    stats = Stats()
+    stats.count('stat')
+    with stats.timer('collect'):
+        pass
+    assert stats.as_dict() == {'counters': {}, 'operations': {}}
+
+
+def test_counters_and_timers():
+    stats = Stats()
+    stats.enabled = True
+    stats.count('stat')
+    stats.count('bytes_copied', 10)
+
+    @stats.timed('collect')
+    def collect():
+        pass
+    collect()
+    collect()
+
+    data = stats.as_dict()
+    assert data['counters'] == {'stat': 1, 'bytes_copied': 10}
+    assert data['operations']['collect']['calls'] == 2
+    assert 'collect' in stats.report()
@@ -0,0 +1,579 @@
+import json
+import os
+import shutil
+
+from realitymarble import Phantasm, RealityMarble
+from realitymarble import utils
+from realitymarble.plan import Plan
+
+
+class LegacyPhantasm(Phantasm):
+    """a custom phantasm written against the original constructor"""
+
+    def __init__(self, base_path, joint_path):
+        super(LegacyPhantasm, self).__init__(base_path, joint_path)
+
+
+def test_match_longest_joint_path(marble, joint):
+    (score, oper) = marble._match_phantasms(str(joint / 'home' / '.local' / 'bin' / 'foo'))
+    assert score == len(str(joint / 'home' / '.local' / 'bin')) + 1
+    assert oper.internal_path == os.path.join(marble.path, 'scripts', 'foo')
+
+    (score, oper) = marble._match_phantasms(str(joint / 'home' / '.vimrc'))
+    assert oper.internal_path == os.path.join(marble.path, 'home', 'vimrc')
+
+
+def test_match_no_phantasm(marble, tmp_path):
+    assert marble._match_phantasms(str(tmp_path / 'elsewhere' / 'foo')) == (0, None)
+
+
+def test_match_respects_component_boundary(marble, joint):
+    assert marble._match_phantasms(str(joint / 'etcetera' / 'foo')) == (0, None)
+
+
+def test_phantasms_not_shared(marble, tmp_path):
+    assert len(marble.phantasms) == 3
+
+
+def test_apply_projects_missing_files(marble, joint):
+    for relpath in ['etc/fstab', 'etc/nginx/nginx.conf', 'home/vimrc', 'home/config/nvim/init.vim',
+                    'scripts/foo']:
+        internal = os.path.join(marble.path, relpath)
+        os.makedirs(os.path.dirname(internal), exist_ok=True)
+        with open(internal, 'w') as f:
+            f.write(relpath)
+
+    assert marble.apply()
+
+    expected = {
+        'etc/fstab': 'etc/fstab',
+        'etc/nginx/nginx.conf': 'etc/nginx/nginx.conf',
+        'home/.vimrc': 'home/vimrc',
+        'home/.config/nvim/init.vim': 'home/config/nvim/init.vim',
+        'home/.local/bin/foo': 'scripts/foo',
+    }
+    for external, internal in expected.items():
+        assert os.readlink(str(joint / external)) == os.path.join(marble.path, internal)
+
+    # nothing left to do on a second run
+    assert marble.apply()
+
+
+def test_index_tracks_collect_and_drop(marble, joint):
+    external = joint / 'etc' / 'fstab'
+    external.write_text('fstab')
+
+    assert marble.collect(str(external))
+    internal = os.path.join(marble.path, 'etc', 'fstab')
+    entry = RealityMarble(marble.path).index.get(internal)
+    assert entry.external_path == str(external)
+    assert entry.phantasm == 'etc'
+    assert entry.size == len('fstab')
+
+    assert marble.drop(str(external))
+    assert RealityMarble(marble.path).index.get(internal) is None
+
+
+def test_status(marble, joint, tmp_path):
+    for name in ['projected', 'missing', 'replaced', 'dangling', 'elsewhere', 'drifted']:
+        internal = os.path.join(marble.path, 'etc', name)
+        os.makedirs(os.path.dirname(internal), exist_ok=True)
+        with open(internal, 'w') as f:
+            f.write(name)
+    etc = joint / 'etc'
+    os.symlink(os.path.join(marble.path, 'etc', 'projected'), str(etc / 'projected'))
+    (etc / 'replaced').write_text('replaced')
+    os.symlink(str(tmp_path / 'nowhere'), str(etc / 'dangling'))
+    (tmp_path / 'other').write_text('other')
+    os.symlink(str(tmp_path / 'other'), str(etc / 'elsewhere'))
+    (etc / 'drifted').write_text('changed')
+
+    states = {os.path.basename(oper.external_path): state for (state, oper) in marble.status()}
+    assert states == {name: name for name in states}
+    assert len(states) == 6
+
+
+def test_recover_interrupted_collect(marble, joint):
+    external = joint / 'etc' / 'fstab'
+    external.write_text('fstab')
+    (score, oper) = marble._match_phantasms(str(external))
+    # crash right after copying into the marble
+    marble.journal.begin('collect', oper)
+    # the process dies, and its lock with it
+    marble.journal.unlock()
+    os.makedirs(os.path.dirname(oper.internal_path))
+    with open(oper.internal_path, 'w') as f:
+        f.write('fstab')
+
+    recovered = RealityMarble(marble.path)
+    assert os.readlink(str(external)) == oper.internal_path
+    assert recovered.index.get(oper.internal_path) is not None
+    assert not os.path.exists(recovered.journal.path)
+
+
+def test_no_recovery_while_batch_is_open(marble, joint):
+    external = joint / 'etc' / 'fstab'
+    external.write_text('fstab')
+    (score, oper) = marble._match_phantasms(str(external))
+    with marble.batch():
+        marble.journal.begin('collect', oper)
+        other = RealityMarble(marble.path)
+        assert not os.path.islink(str(external))
+        assert os.path.exists(other.journal.path)
+    assert not os.path.exists(marble.journal.path)
+
+
+def test_batch_syncs_once_per_filesystem(marble, joint, monkeypatch):
+    from realitymarble import journal
+    synced = []
+    monkeypatch.setattr(journal, '_syncfs', synced.append)
+    paths = []
+    for i in range(20):
+        (joint / 'etc' / str(i)).write_text(str(i))
+        paths.append(str(joint / 'etc' / str(i)))
+    assert all(r.outcome == 'ok' for r in marble.iter_collect(paths))
+    assert len(synced) == 1
+
+
+def test_journal_removed_after_batch(marble, joint):
+    external = joint / 'etc' / 'fstab'
+    external.write_text('fstab')
+    assert marble.collect(str(external))
+    assert not os.path.exists(marble.journal.path)
+
+
+def test_iter_results_concurrently(marble, joint):
+    paths = []
+    for i in range(20):
+        external = joint / 'etc' / 'file{}'.format(i)
+        external.write_text(str(i))
+        paths.append(str(external))
+    paths.append(str(joint / 'etc' / 'missing'))
+
+    results = {r.path: r.outcome for r in marble.iter_results('collect', paths, jobs=4)}
+    assert [results[path] for path in paths] == ['ok'] * 20 + ['failed']
+    assert all(os.path.islink(path) for path in paths[:-1])
+    assert len(RealityMarble(marble.path).index.entries) == 20
+
+
+def test_plan_then_execute(marble, joint):
+    internal = os.path.join(marble.path, 'etc', 'nginx', 'nginx.conf')
+    os.makedirs(os.path.dirname(internal))
+    with open(internal, 'w') as f:
+        f.write('conf')
+    external = joint / 'etc' / 'nginx' / 'nginx.conf'
+
+    plan = marble.plan()
+    assert [step[0] for step in plan.items[0].steps] == ['mkdir', 'symlink']
+    assert not external.parent.exists()
+
+    plan = Plan.from_json(plan.to_json())
+    assert marble.apply(plan)
+    assert os.readlink(str(external)) == internal
+    assert len(marble.plan()) == 0
+
+
+def test_stale_plan_is_refused(marble, joint):
+    external = joint / 'etc' / 'fstab'
+    external.write_text('external')
+    plan = marble.plan([str(external)], action='collect')
+    assert not plan.conflicts
+
+    internal = os.path.join(marble.path, 'etc', 'fstab')
+    os.makedirs(os.path.dirname(internal))
+    with open(internal, 'w') as f:
+        f.write('created after planning')
+    assert not marble.apply(plan)
+    with open(internal) as f:
+        assert f.read() == 'created after planning'
+    assert external.read_text() == 'external'
+
+
+def test_plan_reports_conflicts(marble, joint):
+    external = joint / 'etc' / 'fstab'
+    os.symlink(str(joint / 'nowhere'), str(external))
+    plan = marble.plan([str(external), str(joint / 'unmanaged')], action='collect')
+    assert len(plan.conflicts) == 2
+
+
+def test_project_merges_external_changes(marble, joint, monkeypatch):
+    external = joint / 'etc' / 'pacman.conf'
+    external.write_text('[options]\nColor\n\n[core]\n')
+    assert marble.collect(str(external))
+    internal = marble.path + 'etc/pacman.conf'
+    with open(internal, 'w') as f:
+        f.write('[options]\nColor\nParallelDownloads = 5\n\n[core]\n')
+    # a package update replaces the link
+    os.unlink(str(external))
+    external.write_text('[options]\nColor\n\n[core]\n\n[extra]\n')
+
+    monkeypatch.setenv('EDITOR', 'false')
+    assert marble.project(str(external))
+    assert os.readlink(str(external)) == internal
+    with open(internal) as f:
+        assert f.read() == '[options]\nColor\nParallelDownloads = 5\n\n[core]\n\n[extra]\n'
+
+
+def test_project_keeps_conflicts_unmerged(marble, joint, monkeypatch):
+    external = joint / 'etc' / 'hostname'
+    external.write_text('base\n')
+    assert marble.collect(str(external))
+    internal = marble.path + 'etc/hostname'
+    with open(internal, 'w') as f:
+        f.write('ours\n')
+    os.unlink(str(external))
+    external.write_text('theirs\n')
+
+    # the editor leaves the conflict unresolved
+    monkeypatch.setenv('EDITOR', 'true')
+    assert not marble.project(str(external))
+    assert external.read_text() == 'theirs\n'
+    with open(internal) as f:
+        assert f.read() == 'ours\n'
+    assert os.listdir(marble.path + 'etc') == ['hostname']
+
+
+def test_directory_phantasm(tmp_path, joint):
+    marble_path = tmp_path / 'dirmarble'
+    (marble_path / 'config' / 'nvim' / 'lua').mkdir(parents=True)
+    (marble_path / 'config' / 'nvim' / 'init.vim').write_text('init')
+    (marble_path / 'config' / 'nvim' / 'lua' / 'plugins.lua').write_text('plugins')
+    (marble_path / 'config' / 'git').mkdir()
+    (marble_path / 'config' / 'git' / 'config').write_text('git')
+    (marble_path / '.realitymarble').write_text(json.dumps({'phantasms': [
+        {'name': 'config', 'type': 'realitymarble.DirectoryPhantasm',
+         'joint_path': str(joint / 'home' / '.config')},
+    ]}))
+    external = joint / 'home' / '.config'
+    # git has unmanaged siblings outside, nvim doesn't exist yet
+    (external / 'git').mkdir(parents=True)
+    (external / 'git' / 'ignore').write_text('unmanaged')
+
+    marble = RealityMarble(str(marble_path))
+    assert marble.apply()
+
+    assert os.readlink(str(external / 'nvim')) == os.path.join(marble.path, 'config', 'nvim')
+    assert os.readlink(str(external / 'git' / 'config')) == os.path.join(marble.path, 'config', 'git', 'config')
+    assert (external / 'git' / 'ignore').read_text() == 'unmanaged'
+    assert sorted(state for (state, _) in marble.status()) == ['projected', 'projected']
+
+    # projecting a file inside a projected directory is a no-op, not a self-overwrite
+    assert marble.project(str(external / 'nvim' / 'init.vim'))
+    assert (marble_path / 'config' / 'nvim' / 'init.vim').read_text() == 'init'
+
+    # the directory link is unmanaged as a whole
+    assert marble.materialize(str(external / 'nvim'))
+    assert not os.path.islink(str(external / 'nvim'))
+    assert (external / 'nvim' / 'lua' / 'plugins.lua').read_text() == 'plugins'
+    shutil.rmtree(str(external / 'nvim'))
+    assert marble.project(str(external / 'nvim'))
+    assert marble.drop(str(external / 'nvim'))
+    assert (external / 'nvim' / 'init.vim').read_text() == 'init'
+    assert not (marble_path / 'config' / 'nvim').exists()
+
+
+def test_alternate_root(tmp_path):
+    root = tmp_path / 'rootfs'
+    (root / 'etc').mkdir(parents=True)
+    marble_path = root / 'srv' / 'marble'
+    (marble_path / 'etc').mkdir(parents=True)
+    (marble_path / 'etc' / 'hostname').write_text('box')
+    (marble_path / '.realitymarble').write_text(json.dumps({'phantasms': [
+        {'name': 'etc', 'type': 'realitymarble.Phantasm', 'joint_path': '/etc'},
+    ]}))
+
+    marble = RealityMarble(str(marble_path), root=str(root))
+    assert marble.phantasms[0].joint_path == str(root / 'etc') + os.sep
+    assert marble.apply()
+
+    # links are valid from inside the root
+    assert os.readlink(str(root / 'etc' / 'hostname')) == '/srv/marble/etc/hostname'
+    assert [state for (state, _) in marble.status()] == ['projected']
+    assert marble.materialize('/etc/hostname')
+    assert (root / 'etc' / 'hostname').read_text() == 'box'
+
+
+def test_apply_to_many_roots(tmp_path):
+    marble_path = tmp_path / 'marble'
+    (marble_path / 'etc').mkdir(parents=True)
+    (marble_path / 'etc' / 'hostname').write_text('box')
+    (marble_path / '.realitymarble').write_text(json.dumps({'phantasms': [
+        {'name': 'etc', 'type': 'realitymarble.Phantasm', 'joint_path': str(tmp_path / 'host' / 'etc')},
+    ]}))
+    roots = [tmp_path / 'rootfs{}'.format(i) for i in range(5)]
+    for root in roots:
+        root.mkdir()
+
+    marble = RealityMarble(str(marble_path))
+    results = marble.apply_to([str(root) for root in roots], jobs=3)
+    assert [(r.projected, r.failed) for r in results] == [(1, 0)] * 5
+    for root in roots:
+        external = root / os.path.relpath(str(tmp_path / 'host' / 'etc' / 'hostname'), os.sep)
+        assert os.readlink(str(external)) == os.path.join(marble.path, 'etc', 'hostname')
+    # the index only tracks our own root
+    assert marble.index.entries == {}
+    assert [r.skipped for r in marble.apply_to([str(roots[0])])] == [1]
+
+
+def test_iter_results_stream_records(marble, joint):
+    for name in ('a', 'b'):
+        (joint / 'etc' / name).write_text(name)
+
+    def paths():
+        yield str(joint / 'etc' / 'a')
+        yield str(joint / 'etc' / 'missing')
+        yield str(joint / 'etc' / 'b')
+
+    results = list(marble.iter_collect(paths()))
+    assert [(r.path, r.action, r.outcome) for r in results] == [
+        (str(joint / 'etc' / 'a'), 'collect', 'ok'),
+        (str(joint / 'etc' / 'missing'), 'collect', 'failed'),
+        (str(joint / 'etc' / 'b'), 'collect', 'ok'),
+    ]
+    assert results[0].reason is None
+    assert results[1].reason == 'No such file: {}'.format(joint / 'etc' / 'missing')
+    assert all(r.elapsed >= 0 for r in results)
+
+    results = {r.path: r for r in marble.iter_drop((str(joint / 'etc' / name) for name in ('a', 'b', 'c')), jobs=2)}
+    assert [results[str(joint / 'etc' / name)].outcome for name in ('a', 'b', 'c')] == ['ok', 'ok', 'failed']
+    assert 'Not a managed symlink' in results[str(joint / 'etc' / 'c')].reason
+    assert not os.path.islink(str(joint / 'etc' / 'a'))
+
+
+def test_project_backs_up_replaced_file(marble, joint):
+    external = joint / 'etc' / 'motd'
+    external.write_text('welcome')
+    assert marble.collect(str(external))
+    os.unlink(str(external))
+    external.write_text('welcome')
+    assert marble.project(str(external))
+    assert os.path.islink(str(external))
+
+    assert [entry.path for entry in marble.list_backups(str(external))] == [str(external)]
+    assert marble.restore(str(external))
+    assert not os.path.islink(str(external))
+    assert external.read_text() == 'welcome'
+    assert not marble.restore(str(joint / 'etc' / 'never'))
+
+
+def test_layers_resolve_from_highest(tmp_path):
+    host = tmp_path / 'host' / 'etc'
+    host.mkdir(parents=True)
+    marble_path = tmp_path / 'common'
+    (marble_path / 'etc').mkdir(parents=True)
+    (marble_path / '.realitymarble').write_text(json.dumps({
+        'layers': ['../role', '../myhost'],
+        'phantasms': [{'name': 'etc', 'type': 'realitymarble.Phantasm', 'joint_path': str(host)}],
+    }))
+    for (layer, names) in (('common', 'abc'), ('role', 'bd'), ('myhost', 'c')):
+        (tmp_path / layer / 'etc').mkdir(parents=True, exist_ok=True)
+        for name in names:
+            (tmp_path / layer / 'etc' / name).write_text(layer)
+
+    marble = RealityMarble(str(marble_path))
+    assert marble._match_phantasms(str(host / 'c'))[1].internal_path == str(tmp_path / 'myhost' / 'etc' / 'c')
+    assert marble.apply()
+    assert {name: (host / name).read_text() for name in 'abcd'} == {
+        'a': 'common', 'b': 'role', 'c': 'myhost', 'd': 'role'}
+
+    # a new override in a higher layer takes over the existing link
+    (tmp_path / 'myhost' / 'etc' / 'a').write_text('myhost')
+    marble = RealityMarble(str(marble_path))
+    assert [state for (state, oper) in marble.status() if oper.external_path == str(host / 'a')] == ['elsewhere']
+    assert marble.project(str(host / 'a'))
+    assert (host / 'a').read_text() == 'myhost'
+
+    # dropping the override falls back to the layer below
+    assert marble.drop(str(host / 'a'))
+    assert not (tmp_path / 'myhost' / 'etc' / 'a').exists()
+    assert marble._match_phantasms(str(host / 'a'))[1].internal_path == str(marble_path / 'etc' / 'a')
+
+
+def test_layers_apply_saved_plan(tmp_path):
+    host = tmp_path / 'host' / 'etc'
+    host.mkdir(parents=True)
+    marble_path = tmp_path / 'common'
+    (marble_path / 'etc').mkdir(parents=True)
+    (marble_path / '.realitymarble').write_text(json.dumps({
+        'layers': ['../myhost'],
+        'phantasms': [{'name': 'etc', 'type': 'realitymarble.Phantasm', 'joint_path': str(host)}],
+    }))
+    (marble_path / 'etc' / 'a').write_text('common')
+    marble = RealityMarble(str(marble_path))
+    assert marble.apply()
+
+    # the override takes over a link into the layer below, which is ours as well
+    (tmp_path / 'myhost' / 'etc').mkdir(parents=True)
+    (tmp_path / 'myhost' / 'etc' / 'a').write_text('myhost')
+    marble = RealityMarble(str(marble_path))
+    plan = Plan.from_json(marble.plan().to_json())
+    assert not plan.conflicts
+    assert marble.apply(plan)
+    assert (host / 'a').read_text() == 'myhost'
+
+
+def test_unhidden_file_projected_where_collected(marble, joint):
+    external = joint / 'home' / 'notes.txt'
+    external.write_text('notes')
+    assert marble.collect(str(external))
+
+    marble = RealityMarble(marble.path)
+    assert [(state, oper.external_path) for (state, oper) in marble.status()] == [('projected', str(external))]
+    assert marble.apply()
+    assert not (joint / 'home' / '.notes.txt').exists()
+
+
+def test_unreadable_files_fail_alone(marble, joint, monkeypatch):
+    from realitymarble.utils import content
+    for name in ('ok', 'denied'):
+        external = joint / 'etc' / name
+        external.write_text(name)
+        assert marble.collect(str(external))
+        os.unlink(str(external))
+        external.write_text(name)
+
+    same_content = content.same_content
+
+    def deny(path1, path2, **kwargs):
+        if 'denied' in path1 + path2:
+            raise PermissionError(13, 'Permission denied', path1)
+        return same_content(path1, path2, **kwargs)
+    monkeypatch.setattr(content, 'same_content', deny)
+    content_hash = content.content_hash
+
+    def deny_hash(path, st=None):
+        if os.path.basename(path) == 'denied':
+            raise PermissionError(13, 'Permission denied', path)
+        return content_hash(path, st)
+    monkeypatch.setattr(content, 'content_hash', deny_hash)
+
+    states = {os.path.basename(oper.external_path): state for (state, oper) in marble.status()}
+    assert states == {'ok': 'replaced', 'denied': 'drifted'}
+    assert not marble.project(str(joint / 'etc' / 'denied'))
+    assert not marble.apply()
+    assert os.path.islink(str(joint / 'etc' / 'ok'))
+    assert not os.path.islink(str(joint / 'etc' / 'denied'))
+
+
+def test_object_store_files_edited_in_place(tmp_path, joint):
+    marble_path = tmp_path / 'objmarble'
+    marble_path.mkdir()
+    (marble_path / '.realitymarble').write_text(json.dumps({'object_store': True, 'phantasms': [
+        {'name': 'etc', 'type': 'realitymarble.Phantasm', 'joint_path': str(joint / 'etc')},
+    ]}))
+    marble = RealityMarble(str(marble_path))
+    for name in ('a.conf', 'b.conf'):
+        (joint / 'etc' / name).write_text('same\n')
+        assert marble.collect(str(joint / 'etc' / name))
+
+    with open(str(joint / 'etc' / 'a.conf'), 'a') as f:
+        f.write('edited\n')
+    assert (joint / 'etc' / 'b.conf').read_text() == 'same\n'
+    (score, oper) = marble._match_phantasms(str(joint / 'etc' / 'a.conf'))
+    with open(marble._base_version(oper)) as f:
+        assert f.read() == 'same\n'
+
+
+def test_alternate_root_resolves_links_inside(tmp_path):
+    root = tmp_path / 'rootfs'
+    host_home = tmp_path / 'hosthome'
+    host_home.mkdir()
+    (root / host_home.relative_to('/')).mkdir(parents=True)
+    # an absolute link inside the image, meant to resolve inside the image
+    os.symlink(str(host_home), str(root / 'home'))
+    marble_path = root / 'srv' / 'marble'
+    (marble_path / 'home').mkdir(parents=True)
+    (marble_path / 'home' / 'bashrc').write_text('bashrc')
+    (marble_path / '.realitymarble').write_text(json.dumps({'phantasms': [
+        {'name': 'home', 'type': 'realitymarble.NoHiddenPhantasm', 'joint_path': '/home'},
+    ]}))
+
+    marble = RealityMarble(str(marble_path), root=str(root))
+    assert marble.apply()
+    assert os.listdir(str(host_home)) == []
+    assert os.path.islink(str(root / host_home.relative_to('/') / '.bashrc'))
+    assert marble.materialize(str(root / 'home' / '.bashrc'))
+    assert os.listdir(str(host_home)) == []
+
+
+def test_custom_phantasm_with_original_constructor(tmp_path, joint):
+    marble_path = tmp_path / 'custom'
+    marble_path.mkdir()
+    (marble_path / '.realitymarble').write_text(json.dumps({'phantasms': [
+        {'name': 'etc', 'type': 'tests.test_marble.LegacyPhantasm', 'joint_path': str(joint / 'etc'),
+         'exclude': ['*.bak']},
+    ]}))
+    marble = RealityMarble(str(marble_path))
+    assert isinstance(marble.phantasms[0], LegacyPhantasm)
+    assert not marble.phantasms[0].discoverable('fstab.bak', False)
+    (joint / 'etc' / 'fstab').write_text('fstab')
+    assert marble.collect(str(joint / 'etc' / 'fstab'))
+
+
+def test_phantasm_from_config_keeps_paths(monkeypatch):
+    from realitymarble import NoHiddenPhantasm
+
+    def unexpected(path):
+        raise AssertionError('paths are resolved again')
+    monkeypatch.setattr(utils, 'canonical_path', unexpected)
+    phantasm = NoHiddenPhantasm.from_config('/marble/home', '/mnt/home', exclude=['*.bak'], root='/mnt')
+    assert (phantasm.base_path, phantasm.joint_path, phantasm.root) == ('/marble/home', '/mnt/home', '/mnt')
+    assert not phantasm.discoverable('vimrc.bak', False)
+    assert phantasm.match('/mnt/home/.vimrc')[1].internal_path == '/marble/home/vimrc'
+
+
+def test_status_compares_with_recorded_hash(marble, joint, monkeypatch):
+    from realitymarble.utils import content
+    for name in ('same', 'changed'):
+        external = joint / 'etc' / name
+        external.write_text(name)
+        assert marble.collect(str(external))
+        os.unlink(str(external))
+        external.write_text(name if name == 'same' else 'egnahc')
+
+    def unexpected(*args, **kwargs):
+        raise AssertionError('internal files are read again')
+    monkeypatch.setattr(content, 'same_content', unexpected)
+    states = {os.path.basename(oper.external_path): state for (state, oper) in marble.status()}
+    assert states == {'same': 'replaced', 'changed': 'drifted'}
+
+
+def test_alternate_root_needs_no_sudo_when_writable(tmp_path, monkeypatch):
+    from realitymarble.utils import sudolib
+    root = tmp_path / 'rootfs'
+    (root / 'etc').mkdir(parents=True)
+    marble_path = root / 'srv' / 'marble'
+    (marble_path / 'etc').mkdir(parents=True)
+    (marble_path / 'etc' / 'hostname').write_text('box')
+    (marble_path / '.realitymarble').write_text(json.dumps({'phantasms': [
+        {'name': 'etc', 'type': 'realitymarble.Phantasm', 'joint_path': '/etc'},
+    ]}))
+    elevated = []
+    monkeypatch.setattr(sudolib, 'elevated', lambda: elevated.append(True))
+    # the host's /etc may not be writable, the one in the root is
+    monkeypatch.setattr(utils, 'writable', lambda path: utils.is_sub(str(root), path))
+
+    marble = RealityMarble(str(marble_path), root=str(root))
+    assert [r.outcome for r in marble.iter_project(['/etc/hostname'])] == ['ok']
+    assert elevated == []
+
+
+def test_project_survives_failing_editor(marble, joint, monkeypatch):
+    external = joint / 'etc' / 'hostname'
+    external.write_text('base\n')
+    other = joint / 'etc' / 'motd'
+    other.write_text('hello\n')
+    assert marble.collect(str(external))
+    assert marble.collect(str(other))
+    internal = marble.path + 'etc/hostname'
+    with open(internal, 'w') as f:
+        f.write('ours\n')
+    os.unlink(str(external))
+    external.write_text('theirs\n')
+
+    # the editor exits with an error instead of resolving the conflict
+    monkeypatch.setenv('EDITOR', 'false')
+    assert not marble.project(str(external))
+    assert external.read_text() == 'theirs\n'
+    assert not marble.apply()
+    assert os.readlink(str(other)) == marble.path + 'etc/motd'
@@ -0,0 +1,43 @@
+from realitymarble.utils import merge
+
+
+def lines(text):
+    return [line.encode() + b'\n' for line in text.split()]
+
+
+def test_merge3_takes_changes_from_both_sides():
+    base = lines('a b c d e f g')
+    ours = lines('a B c d e f g')
+    theirs = lines('a b c d e F g h')
+    assert merge.merge3(base, ours, theirs) == (lines('a B c d e F g h'), 0)
+
+
+def test_merge3_trivial_cases():
+    base = lines('a b c')
+    changed = lines('a x c')
+    assert merge.merge3(base, base, changed) == (changed, 0)
+    assert merge.merge3(base, changed, base) == (changed, 0)
+    assert merge.merge3(base, changed, changed) == (changed, 0)
+
+
+def test_merge3_marks_conflicts():
+    (result, conflicts) = merge.merge3(lines('a b c'), lines('a x c'), lines('a y c'))
+    assert conflicts == 1
+    assert result == (lines('a') + [merge.MARKER_OURS] + lines('x') + [merge.MARKER_BASE] + lines('b') +
+                      [merge.MARKER_SEP] + lines('y') + [merge.MARKER_THEIRS] + lines('c'))
+
+
+def test_merge_files(tmp_path):
+    for (name, text) in (('base', 'one\ntwo\nthree\nfour'), ('ours', 'one\n2\nthree\nfour'),
+                         ('theirs', 'one\ntwo\nthree\nfour\nfive')):
+        (tmp_path / name).write_text(text)
+    (merged, conflicts) = merge.merge_files(*[str(tmp_path / name) for name in ('base', 'ours', 'theirs')])
+    assert (merged, conflicts) == (b'one\n2\nthree\nfour\nfive', 0)
+
+
+def test_has_conflicts_ignores_separator_lines(tmp_path):
+    path = tmp_path / 'README'
+    path.write_bytes(b'Title\n' + merge.MARKER_SEP + b'text\n')
+    assert not merge.has_conflicts(str(path))
+    path.write_bytes(b'Title\n' + merge.MARKER_OURS + b'a\n' + merge.MARKER_SEP + b'b\n' + merge.MARKER_THEIRS)
+    assert merge.has_conflicts(str(path))
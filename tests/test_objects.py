@@ -0,0 +1,63 @@
+import os
+
+from realitymarble.objects import ObjectStore
+
+
+def test_add_deduplicates(tmp_path):
+    store = ObjectStore(str(tmp_path))
+    (tmp_path / 'a').write_text('same')
+    (tmp_path / 'b').write_text('same')
+    digest = store.add(str(tmp_path / 'a'))
+    assert store.add(str(tmp_path / 'b')) == digest
+    assert [d for (d, _) in store.iter_objects()] == [digest]
+    assert store.find(str(tmp_path / 'b')) == digest
+
+
+def test_link_and_gc(tmp_path):
+    store = ObjectStore(str(tmp_path), link='hardlink')
+    (tmp_path / 'a').write_text('kept')
+    (tmp_path / 'b').write_text('gone')
+    kept = store.add(str(tmp_path / 'a'))
+    gone = store.add(str(tmp_path / 'b'))
+    store.link(kept, str(tmp_path / 'phantasm' / 'a'))
+    assert os.stat(str(tmp_path / 'phantasm' / 'a')).st_ino == os.stat(store.object_path(kept)).st_ino
+
+    assert store.gc(set()) == (1, len('gone'))
+    assert kept in store
+    assert gone not in store
+
+
+def test_reflink_mode_makes_separate_files(tmp_path):
+    store = ObjectStore(str(tmp_path))
+    (tmp_path / 'a').write_text('content')
+    digest = store.add(str(tmp_path / 'a'))
+    store.link(digest, str(tmp_path / 'phantasm' / 'a'))
+    assert (tmp_path / 'phantasm' / 'a').read_text() == 'content'
+    assert os.stat(str(tmp_path / 'phantasm' / 'a')).st_ino != os.stat(store.object_path(digest)).st_ino
+
+
+def test_add_replaces_object_modified_through_hardlink(tmp_path):
+    store = ObjectStore(str(tmp_path), link='hardlink')
+    (tmp_path / 'a').write_text('content')
+    digest = store.add(str(tmp_path / 'a'))
+    store.link(digest, str(tmp_path / 'phantasm' / 'a'))
+    with open(str(tmp_path / 'phantasm' / 'a'), 'a') as f:
+        f.write(' edited')
+
+    assert store.add(str(tmp_path / 'a')) == digest
+    with open(store.object_path(digest)) as f:
+        assert f.read() == 'content'
+
+
+def test_reflink_mode_warns_without_cow(tmp_path, monkeypatch, caplog):
+    from realitymarble import primitives
+
+    def unsupported(*args):
+        raise OSError('unsupported')
+    monkeypatch.setattr(primitives, '_clone', unsupported)
+    store = ObjectStore(str(tmp_path))
+    (tmp_path / 'a').write_text('content')
+    digest = store.add(str(tmp_path / 'a'))
+    store.link(digest, str(tmp_path / 'phantasm' / 'a'))
+    store.link(digest, str(tmp_path / 'phantasm' / 'b'))
+    assert len([r for r in caplog.records if 'does not support reflinks' in r.getMessage()]) == 1
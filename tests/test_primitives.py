@@ -0,0 +1,100 @@
+import os
+
+import pytest
+from realitymarble import primitives
+
+
+@pytest.fixture(params=['clone', 'copy_file_range', 'sendfile', 'userspace'])
+def method(request, monkeypatch):
+    """force the copy engine down to one of its fallbacks"""
+    def unsupported(*args):
+        raise OSError('unsupported')
+    skip = {
+        'clone': [],
+        'copy_file_range': ['_clone'],
+        'sendfile': ['_clone', '_copy_file_range'],
+        'userspace': ['_clone', '_copy_file_range', '_sendfile'],
+    }[request.param]
+    for name in skip:
+        monkeypatch.setattr(primitives, name, unsupported)
+    return request.param
+
+
+def test_copy_preserves_content_and_metadata(tmp_path, method):
+    src = tmp_path / 'src'
+    src.write_bytes(os.urandom(300000))
+    os.chmod(str(src), 0o751)
+    os.utime(str(src), ns=(1000000000, 2000000000))
+
+    dest = tmp_path / 'sub' / 'dest'
+    primitives.copy(str(src), str(dest))
+
+    assert dest.read_bytes() == src.read_bytes()
+    st = os.stat(str(dest))
+    assert st.st_mode & 0o777 == 0o751
+    assert st.st_mtime_ns == 2000000000
+    assert os.listdir(str(tmp_path / 'sub')) == ['dest']
+
+
+def test_copy_replaces_symlink(tmp_path):
+    src = tmp_path / 'src'
+    src.write_text('content')
+    dest = tmp_path / 'dest'
+    os.symlink(str(src), str(dest))
+
+    primitives.copy(str(src), str(dest))
+    assert not os.path.islink(str(dest))
+    assert dest.read_text() == 'content'
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason='changing owners needs root')
+def test_copy_to_host_keeps_owner_of_replaced(tmp_path):
+    src = tmp_path / 'src'
+    src.write_text('content')
+    os.chown(str(src), 1000, 1000)
+
+    dest = tmp_path / 'dest'
+    os.symlink(str(src), str(dest))
+    primitives.copy(str(src), str(dest), preserve_owner=False)
+    assert os.stat(str(dest)).st_uid == 0
+
+    primitives.copy(str(src), str(tmp_path / 'new'), preserve_owner=False)
+    assert os.stat(str(tmp_path / 'new')).st_uid == 0
+    primitives.copy(str(src), str(tmp_path / 'collected'))
+    assert os.stat(str(tmp_path / 'collected')).st_uid == 1000
+
+
+def test_editors_take_turns(tmp_path, monkeypatch):
+    import subprocess
+    import threading
+    import time
+    running = []
+    overlapped = []
+
+    def run(cmd, check):
+        running.append(cmd)
+        overlapped.append(len(running) > 1)
+        time.sleep(0.01)
+        running.remove(cmd)
+    monkeypatch.setattr(subprocess, 'run', run)
+
+    threads = [threading.Thread(target=primitives.edit, args=(str(tmp_path / str(i)),)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlapped == [False] * 4
+
+
+def test_managed_reads_links_only(tmp_path, monkeypatch):
+    from realitymarble.instrument import stats
+    monkeypatch.setattr(stats, 'enabled', True)
+    stats.reset()
+    (tmp_path / 'file').write_text('data')
+    os.symlink(str(tmp_path / 'file'), str(tmp_path / 'link'))
+
+    assert not primitives._managed(str(tmp_path), str(tmp_path / 'file'))
+    assert stats.counters == {'lstat': 1}
+    assert primitives._managed(str(tmp_path), str(tmp_path / 'link'))
+    assert stats.counters == {'lstat': 2, 'readlink': 1}
+    stats.reset()
@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+
+
+# from a cold interpreter to the first operation, without click which only the CLI needs
+STARTUP_BUDGET = 0.05
+
+HEAVY_MODULES = ('concurrent.futures', 'difflib', 'hashlib', 'shutil', 'subprocess', 'tarfile', 'tempfile')
+
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from realitymarble import RealityMarble
+marble = RealityMarble(sys.argv[1])
+(score, oper) = marble._match_phantasms(marble.resolve_external_path(sys.argv[2]))
+elapsed = time.perf_counter() - start
+import realitymarble.cli
+print(json.dumps({{'elapsed': elapsed, 'score': score, 'loaded': [m for m in {} if m in sys.modules]}}))
+'''.format(HEAVY_MODULES)
+
+
+def run_cold(marble, path):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT, marble.path, path], env=env)
+    return json.loads(output.decode())
+
+
+def test_startup_budget(marble, joint):
+    path = str(joint / 'etc' / 'fstab')
+    # the first run may compile bytecode and the config cache
+    runs = [run_cold(marble, path) for _ in range(3)]
+    assert all(run['score'] > 0 for run in runs)
+    assert runs[-1]['loaded'] == []
+    assert min(run['elapsed'] for run in runs) < STARTUP_BUDGET
@@ -0,0 +1,38 @@
+import sys
+
+import pytest
+from realitymarble.utils import sudolib
+
+
+@pytest.fixture
+def helper():
+    # run the helper unprivileged, the protocol is the same
+    helper = sudolib.Helper(command=[sys.executable, '-m', 'realitymarble.utils.sudolib'])
+    yield helper
+    helper.close()
+
+
+def test_call_returns_result(helper):
+    assert helper.call('os.path.join', 'a', 'b') == 'a/b'
+    assert helper.call('os.path.basename', '/x/y') == 'y'
+
+
+def test_call_reuses_process(helper):
+    helper.call('os.getpid')
+    pid = helper._proc.pid
+    helper.call('os.getpid')
+    assert helper._proc.pid == pid
+
+
+def test_call_raises_remote_exception(helper, tmp_path):
+    missing = str(tmp_path / 'missing')
+    with pytest.raises(FileNotFoundError) as excinfo:
+        helper.call('os.unlink', missing)
+    assert excinfo.value.filename == missing
+
+
+def test_close_stops_helper(helper):
+    helper.call('os.getpid')
+    proc = helper._proc
+    helper.close()
+    assert proc.returncode is not None
@@ -0,0 +1,10 @@
+from realitymarble import utils
+
+
+def test_is_sub():
+    assert utils.is_sub('/etc', '/etc/foo')
+    assert utils.is_sub('/etc/', '/etc/foo/bar')
+    assert utils.is_sub('/etc', '/etc')
+    assert utils.is_sub('/', '/etc')
+    assert not utils.is_sub('/etc/foo', '/etc/foobar')
+    assert not utils.is_sub('/etc/foo', '/etc')
@@ -0,0 +1,86 @@
+import os
+import time
+
+from realitymarble import primitives
+from realitymarble.watch import Watcher
+
+
+def poll_until(watcher, predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        watcher.poll(timeout=0.1)
+    return predicate()
+
+
+def test_watch_reprojects_replaced_file(marble, joint):
+    external = joint / 'etc' / 'fstab'
+    external.write_text('fstab')
+    assert marble.collect(str(external))
+
+    events = []
+    watcher = Watcher(marble, reproject=True, debounce=0,
+                      on_event=lambda *event: events.append(event))
+    try:
+        external.unlink()
+        external.write_text('fstab')
+        assert poll_until(watcher, lambda: events)
+        assert events[0][0] == primitives.REPLACED
+        assert events[0][2] == 'reprojected'
+        assert os.path.islink(str(external))
+    finally:
+        watcher.close()
+
+
+def test_watch_queues_drifted_file(marble, joint):
+    external = joint / 'etc' / 'fstab'
+    external.write_text('fstab')
+    assert marble.collect(str(external))
+
+    watcher = Watcher(marble, reproject=True, debounce=0)
+    try:
+        external.unlink()
+        external.write_text('changed by a package manager')
+        assert poll_until(watcher, lambda: watcher.merge_queue)
+        assert watcher.merge_queue[0].external_path == str(external)
+    finally:
+        watcher.close()
+
+
+def test_watch_picks_up_files_added_to_layers(tmp_path):
+    import json
+    from realitymarble import RealityMarble
+    host = tmp_path / 'host' / 'etc'
+    host.mkdir(parents=True)
+    marble_path = tmp_path / 'common'
+    (marble_path / 'etc').mkdir(parents=True)
+    (tmp_path / 'myhost' / 'etc').mkdir(parents=True)
+    (marble_path / '.realitymarble').write_text(json.dumps({
+        'layers': ['../myhost'],
+        'phantasms': [{'name': 'etc', 'type': 'realitymarble.Phantasm', 'joint_path': str(host)}],
+    }))
+    marble = RealityMarble(str(marble_path))
+    watcher = Watcher(marble, debounce=0)
+    try:
+        (tmp_path / 'myhost' / 'etc' / 'hostname').write_text('box')
+        assert poll_until(watcher, lambda: str(host / 'hostname') in watcher._managed)
+    finally:
+        watcher.close()
+
+
+def test_watch_keeps_foreign_dangling_link(marble, joint, tmp_path):
+    external = joint / 'etc' / 'fstab'
+    external.write_text('fstab')
+    assert marble.collect(str(external))
+
+    events = []
+    watcher = Watcher(marble, reproject=True, debounce=0,
+                      on_event=lambda *event: events.append(event))
+    try:
+        external.unlink()
+        os.symlink(str(tmp_path / 'nowhere'), str(external))
+        assert poll_until(watcher, lambda: events)
+        assert events[0][0] == primitives.DANGLING
+        assert events[0][2] == 'failed'
+        assert os.readlink(str(external)) == str(tmp_path / 'nowhere')
+    finally:
+        watcher.close()